@@ -41,9 +41,13 @@ def main(hp, gen_test=False, use_cached_dataset=False,
                                         use_cache=use_cached_dataset)
 
     # Train
-    model.initNN(hp["h_layers"], hp["lr"], hp["lambda"])
+    model.initNN(hp["h_layers"], hp["lr"], hp["lambda"], hp["decay"])
     train_res = model.train(X_v_train, v_train, hp["epochs"],
-                            hp["train_val_test"], freq=hp["log_frequency"])
+                            hp["train_val_test"], freq=hp["log_frequency"],
+                            batch_size=hp["batch_size"],
+                            shuffle_buffer=hp["shuffle_buffer"],
+                            nt_epochs=hp["nt_epochs"],
+                            patience=hp["patience"])
 
     # Predict and restruct
     U_pred = model.predict(X_v_test)
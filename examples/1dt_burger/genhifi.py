@@ -17,18 +17,17 @@ from hyperparams import HP
 n_s = HP["n_s_hifi"]
 
 
-# The solution function
-def u(X, t, mu):
+# The solution function, batched: fills out with the whole time-trajectories
+def u(X, t, mu, out):
     """Burgers2 explicit solution."""
-    x = X[0]
-    mu = mu[0]
-
-    if t == 1.:
-        res = x / (1 + np.exp(1/(4*mu)*(x**2 - 1/4)))
-    else:
-        t0 = np.exp(1 / (8*mu))
-        res = (x/t) / (1 + np.sqrt(t/t0)*np.exp(x**2/(4*mu*t)))
-    return res.reshape((1, x.shape[0]))
+    x = X[0][:, None]
+    n_t = t.shape[0]
+
+    for i in range(mu.shape[0]):
+        t0 = np.exp(1 / (8*mu[i, 0]))
+        # At t = 1 this is x / (1 + exp((x^2 - 1/4) / (4 mu)))
+        out[:, i*n_t:(i+1)*n_t] = \
+            (x/t) / (1 + np.sqrt(t/t0)*np.exp(x**2/(4*mu[i, 0]*t)))
 
 
 class BurgersTestGenerator(TestGenerator):
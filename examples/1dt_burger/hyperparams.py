@@ -29,7 +29,15 @@ HP["h_layers"] = [64, 64]
 # Setting up _structthe TF SGD-based optimizer
 HP["epochs"] = 80000
 HP["lr"] = 0.002
+HP["decay"] = 0.
 HP["lambda"] = 1e-4
+# Minibatches size (0 for full-batch) and shuffle buffer (None for all)
+HP["batch_size"] = 0
+HP["shuffle_buffer"] = None
+# Second-stage L-BFGS iterations, after the Adam epochs
+HP["nt_epochs"] = 0
+# Logs without validation improvement before stopping (None to disable)
+HP["patience"] = None
 # Frequency of the logger
 HP["log_frequency"] = 1000
 # Burgers params
@@ -42,9 +42,13 @@ def main(hp, gen_test=False, use_cached_dataset=False,
                                         use_cache=use_cached_dataset)
 
     # Train
-    model.initNN(hp["h_layers"], hp["lr"], hp["lambda"])
+    model.initNN(hp["h_layers"], hp["lr"], hp["lambda"], hp["decay"])
     train_res = model.train(X_v_train, v_train, hp["epochs"],
-                            hp["train_val_test"], freq=hp["log_frequency"])
+                            hp["train_val_test"], freq=hp["log_frequency"],
+                            batch_size=hp["batch_size"],
+                            shuffle_buffer=hp["shuffle_buffer"],
+                            nt_epochs=hp["nt_epochs"],
+                            patience=hp["patience"])
 
     # Predict and restruct
     U_pred = model.predict(X_v_test)
@@ -58,8 +62,8 @@ def main(hp, gen_test=False, use_cached_dataset=False,
     # Sample the new model to generate a HiFi prediction
     n_s_hifi = hp["n_s_hifi"]
     print("Sampling {n_s_hifi} parameters")
-    X_v_test_hifi = model.generate_hifi_inputs(n_s_hifi, hp["mu_min"], hp["mu_max"],
-                                               hp["t_min"], hp["t_max"])
+    X_v_test_hifi = model.iter_hifi_inputs(n_s_hifi, hp["mu_min"], hp["mu_max"],
+                                           hp["t_min"], hp["t_max"])
     print("Predicting the {n_s_hifi} corresponding solutions")
     U_pred_hifi_mean, U_pred_hifi_std = model.predict_heavy(X_v_test_hifi)
 
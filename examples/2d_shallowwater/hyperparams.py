@@ -24,6 +24,8 @@ HP["epochs"] = 500000
 HP["lr"] = 0.0005
 HP["decay"] = 0.
 HP["lambda"] = 1e-4
+# Logs without validation improvement before stopping (None to disable)
+HP["patience"] = None
 # Frequency of the logger
 HP["log_frequency"] = 5000
 
@@ -42,10 +42,10 @@ def main(hp, use_cached_dataset=False):
     print(X_v_test.shape)
 
     # Create the model and train
-    train_res = model.train(X_v_train, v_train, hp["h_layers"],
-                            hp["epochs"], hp["lr"], hp["lambda"],
-                            hp["train_val_test"], 
-                            hp["decay"], hp["log_frequency"])
+    model.initNN(hp["h_layers"], hp["lr"], hp["lambda"], hp["decay"])
+    train_res = model.train(X_v_train, v_train, hp["epochs"],
+                            hp["train_val_test"], freq=hp["log_frequency"],
+                            patience=hp["patience"])
 
     # Predict and restruct
     U_pred = model.predict(X_v_test)
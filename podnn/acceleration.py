@@ -1,5 +1,6 @@
 """Compiled and parallelized functions."""
 
+import inspect
 import warnings
 import numpy as np
 from numba import jit, prange
@@ -9,32 +10,126 @@ from numba import jit, prange
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
 
-@jit(nopython=True, parallel=True)
-def loop_vdot(n_s, U_tot, U_tot_sq, V, v_pred_hifi):
-    """Return mean, std from parallelized dot product between V an v"""
+@jit(nopython=True, nogil=True)
+def welford_update(n, mean, M2, U_min, U_max, U):
+    """Add the (flat) sample U to the moments in place, return the new count.
+
+    U_min and U_max are only tracked if they aren't empty.
+    """
+    n += 1
+    track_minmax = U_min.shape[0] > 0
+    for k in range(U.shape[0]):
+        delta = U[k] - mean[k]
+        mean[k] += delta / n
+        M2[k] += delta * (U[k] - mean[k])
+        if track_minmax:
+            U_min[k] = min(U_min[k], U[k])
+            U_max[k] = max(U_max[k], U[k])
+    return n
+
+
+@jit(nopython=True, nogil=True)
+def welford_merge(n_a, mean_a, M2_a, U_min_a, U_max_a,
+                  n_b, mean_b, M2_b, U_min_b, U_max_b):
+    """Merge the moments b into a in place (Chan et al.), return the count."""
+    if n_b == 0:
+        return n_a
+    n = n_a + n_b
+    track_minmax = U_min_a.shape[0] > 0
+    for k in range(mean_a.shape[0]):
+        delta = mean_b[k] - mean_a[k]
+        mean_a[k] += delta * n_b / n
+        M2_a[k] += M2_b[k] + delta * delta * n_a * n_b / n
+        if track_minmax:
+            U_min_a[k] = min(U_min_a[k], U_min_b[k])
+            U_max_a[k] = max(U_max_a[k], U_max_b[k])
+    return n
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def loop_vdot(n_s, counts, means, M2s, U_mins, U_maxs, V, v_pred_hifi):
+    """Accumulate moments of the dot product between V an v, per-chunk."""
+    n_chunks = counts.shape[0]
     # pylint: disable=not-an-iterable
-    for i in prange(n_s):
-        # Computing one snapshot
-        U = V.dot(v_pred_hifi[i])
-        # Building the sum and the sum of squaes
-        U_tot += U
-        U_tot_sq += U**2
-    return U_tot, U_tot_sq
-
-
-@jit(nopython=True, parallel=True)
-def loop_vdot_t(n_s, n_t, U_tot, U_tot_sq, V, v_pred_hifi):
-    """Return mean, std from parallelized dot product between V an v (w/ t)."""
+    for c in prange(n_chunks):
+        # Each chunk of samples has its own partial moments
+        for i in range(c * n_s // n_chunks, (c + 1) * n_s // n_chunks):
+            # Computing one snapshot
+            U = V.dot(v_pred_hifi[i])
+            counts[c] = welford_update(counts[c], means[c], M2s[c],
+                                       U_mins[c], U_maxs[c], U)
+    return counts
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def loop_vdot_t(n_s, n_t, counts, means, M2s, U_mins, U_maxs, V, v_pred_hifi):
+    """Accumulate moments of the dot product between V an v (w/ t), per-chunk."""
+    n_chunks = counts.shape[0]
     # pylint: disable=not-an-iterable
-    for i in prange(n_s):
-        # Computing one snapshot
-        s = n_t * i
-        e = n_t * (i + 1)
-        U = V.dot(v_pred_hifi[s:e].T)
-        # Building the sum and the sum of squaes
-        U_tot += U
-        U_tot_sq += U**2
-    return U_tot, U_tot_sq
+    for c in prange(n_chunks):
+        # Each chunk of samples has its own partial moments
+        for i in range(c * n_s // n_chunks, (c + 1) * n_s // n_chunks):
+            # Computing one snapshot
+            s = n_t * i
+            e = n_t * (i + 1)
+            U = V.dot(v_pred_hifi[s:e].T)
+            counts[c] = welford_update(counts[c], means[c], M2s[c],
+                                       U_mins[c], U_maxs[c], U.reshape(-1))
+    return counts
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def loop_moments(u, n_s, counts, means, M2s, U_mins, U_maxs, X, mu_lhs):
+    """Accumulate moments of the snapshots u(X, 0, mu), per-chunk.
+
+    counts grow after each sample, they can be polled to report progress.
+    """
+    n_chunks = counts.shape[0]
+    # pylint: disable=not-an-iterable
+    for c in prange(n_chunks):
+        # Each chunk of samples has its own partial moments
+        for i in range(c * n_s // n_chunks, (c + 1) * n_s // n_chunks):
+            # Computing one snapshot
+            U = np.ascontiguousarray(u(X, 0, mu_lhs[i, :]))
+            counts[c] = welford_update(counts[c], means[c], M2s[c],
+                                       U_mins[c], U_maxs[c], U.reshape(-1))
+    return counts
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def loop_moments_t(u, n_s, n_v, n_xyz, n_t, counts, means, M2s,
+                   U_mins, U_maxs, X, t, mu_lhs):
+    """Accumulate moments of the snapshots u(X, t_j, mu), per-chunk."""
+    n_chunks = counts.shape[0]
+    # pylint: disable=not-an-iterable
+    for c in prange(n_chunks):
+        # One snapshot buffer per chunk
+        U = np.zeros((n_v, n_xyz, n_t))
+        for i in range(c * n_s // n_chunks, (c + 1) * n_s // n_chunks):
+            # Computing one snapshot, step by step
+            for j in range(n_t):
+                U[:, :, j] = u(X, t[j], mu_lhs[i, :])
+            counts[c] = welford_update(counts[c], means[c], M2s[c],
+                                       U_mins[c], U_maxs[c], U.reshape(-1))
+    return counts
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def loop_moments_batch(u, n_s, n_h, counts, means, M2s, U_mins, U_maxs,
+                       X, t, mu_lhs):
+    """Accumulate moments of the snapshots of a batched u, per-chunk."""
+    n_t = t.shape[0]
+    n_chunks = counts.shape[0]
+    # pylint: disable=not-an-iterable
+    for c in prange(n_chunks):
+        # One output slab per chunk, filled in place by u
+        U = np.zeros((n_h, n_t))
+        for i in range(c * n_s // n_chunks, (c + 1) * n_s // n_chunks):
+            # Computing one whole snapshot (time-trajectory)
+            u(X, t, mu_lhs[i:i + 1], U)
+            counts[c] = welford_update(counts[c], means[c], M2s[c],
+                                       U_mins[c], U_maxs[c], U.reshape(-1))
+    return counts
 
 
 @jit(nopython=True, parallel=True)
@@ -74,25 +169,24 @@ def loop_u_t(u, n_s, n_t, n_v, n_xyz, n_h,
     return X_v, U, U_struct
 
 
+def is_batched(u):
+    """Tell if u follows the batched, in-place u(X, t, mu, out) protocol.
+
+    There t is the (n_t,) time steps, mu a (n_b, n_p) block of parameters
+    and out the (n_h, n_b * n_t) snapshots to fill, sample after sample.
+    """
+    u = getattr(u, "py_func", u)
+    return len(inspect.signature(u).parameters) == 4
+
+
 @jit(nopython=True, parallel=True)
-def lhs(n, samples):
-    """Borrowed, parallelized __lhscentered() from pyDOE."""
-
-    # Generate the intervals
-    cut = np.linspace(0, 1, samples + 1)
-
-    # Fill points uniformly in each interval
-    u = np.random.rand(samples, n)
-    a = cut[:samples]
-    b = cut[1:samples + 1]
-    rdpoints = np.zeros(u.shape)
-    for j in prange(n):
-        rdpoints[:, j] = u[:, j]*(b-a) + a
-
-    # Make the random pairings
-    H = np.zeros(rdpoints.shape)
-    for j in prange(n):
-        order = np.random.permutation(np.arange(samples))
-        H[:, j] = rdpoints[order, j]
-
-    return H
+def loop_u_batch(u, n_s, n_t, n_chunks, U, X, mu_lhs, t):
+    """Fill the snapshots matrix with one batched u call per chunk."""
+    # pylint: disable=not-an-iterable
+    for c in prange(n_chunks):
+        s = c * n_s // n_chunks
+        e = (c + 1) * n_s // n_chunks
+        if e > s:
+            # Whole time-trajectories of a block of samples, in place
+            u(X, t, mu_lhs[s:e], U[:, n_t * s:n_t * e])
+    return U
@@ -0,0 +1,125 @@
+"""Module declaring a TensorFlow-free POD-NN predictor, from a .npz bundle."""
+
+import os
+import numpy as np
+from numba import jit
+
+
+def pack_mlp_params(weights):
+    """Return the flat (W_0, b_0, W_1, b_1, ...) params of Keras weights."""
+    return np.concatenate([np.asarray(w, dtype=np.float64).reshape(-1)
+                           for w in weights])
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def mlp_forward(X, params, layers):
+    """Return the outputs of the tanh MLP, for the normalized inputs X.
+
+    Each layer is a GEMM, then a single pass adding the bias and applying
+    the activation in place.
+    """
+    n = X.shape[0]
+    n_layers = layers.shape[0]
+    H = np.ascontiguousarray(X)
+    s = 0
+    for k in range(n_layers - 1):
+        n_in, n_out = layers[k], layers[k + 1]
+        W = params[s:s + n_in * n_out].reshape((n_in, n_out))
+        s += n_in * n_out
+        b = params[s:s + n_out]
+        s += n_out
+
+        Z = np.dot(H, W)
+        if k < n_layers - 2:
+            for i in range(n):
+                for j in range(n_out):
+                    Z[i, j] = np.tanh(Z[i, j] + b[j])
+        else:
+            for i in range(n):
+                for j in range(n_out):
+                    Z[i, j] += b[j]
+        H = Z
+    return H
+
+
+def reconstruct(v, V, pod_blocks=None, U_mean=None, U_scale=None):
+    """Return the snapshots (n_h, n_st) from reduced coefficients v."""
+    if pod_blocks is None:
+        return V.dot(v.T)
+
+    # One small GEMM per block of the block-diagonal bases
+    U = np.zeros((V.shape[0], v.shape[0]))
+    for r0, r1, c0, c1 in pod_blocks:
+        U[r0:r1] = V[r0:r1, c0:c1].dot(v[:, c0:c1].T)
+    if U_scale is not None:
+        U *= U_scale[:, None]
+    if U_mean is not None:
+        U += U_mean[:, None]
+    return U
+
+
+class PodnnBundle:
+    """Trained POD-NN model, predicting with NumPy/numba only.
+
+    It's created by PodnnModel.save_bundle(), and holds the MLP weights,
+    the inputs bounds, the targets standardization and the POD bases.
+    """
+
+    def __init__(self, params, layers, lb, ub, V, v_mean=None, v_std=None,
+                 pod_blocks=None, U_mean=None, U_scale=None, n_t=0):
+        self.params = params
+        self.layers = layers
+        self.lb = lb
+        self.ub = ub
+        self.V = V
+        self.v_mean = v_mean
+        self.v_std = v_std
+        self.pod_blocks = pod_blocks
+        self.U_mean = U_mean
+        self.U_scale = U_scale
+        self.n_t = n_t
+
+    def normalize(self, X):
+        """Apply the same normalization to the inputs X as PodnnModel."""
+        if self.lb is not None and self.ub is not None:
+            return (X - self.lb) - 0.5*(self.ub - self.lb)
+        return X
+
+    def predict_v(self, X_v):
+        """Returns the predicted POD projection coefficients."""
+        X_v = self.normalize(np.atleast_2d(np.asarray(X_v, dtype=np.float64)))
+        v_pred = mlp_forward(X_v, self.params, self.layers)
+        if self.v_mean is not None:
+            v_pred = v_pred * self.v_std + self.v_mean
+        return v_pred
+
+    def predict(self, X_v):
+        """Returns the predicted solutions, via proj coefficients."""
+        return reconstruct(self.predict_v(X_v), self.V, self.pod_blocks,
+                           self.U_mean, self.U_scale)
+
+    def save(self, path):
+        """Save the bundle to a single .npz file."""
+        arrays = {"params": self.params, "layers": self.layers,
+                  "V": self.V, "n_t": np.array(self.n_t)}
+        # Optional parts are just left out
+        optionals = {"lb": self.lb, "ub": self.ub, "v_mean": self.v_mean,
+                     "v_std": self.v_std, "pod_blocks": self.pod_blocks,
+                     "U_mean": self.U_mean, "U_scale": self.U_scale}
+        for key, value in optionals.items():
+            if value is not None:
+                arrays[key] = np.asarray(value)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load a bundle saved by save()."""
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Can't find the bundle {path}.")
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        n_t = int(arrays.pop("n_t"))
+        if "pod_blocks" in arrays:
+            arrays["pod_blocks"] = [tuple(int(i) for i in block)
+                                    for block in arrays["pod_blocks"]]
+        return cls(n_t=n_t, **arrays)
@@ -0,0 +1,97 @@
+"""Load generator of the prediction server, measuring throughput and latency.
+
+python -m podnn.loadgen --port 8000 --n-requests 10000 --concurrency 64
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+
+
+async def send(reader, writer, method, path, payload=None):
+    """Send a request on a keep-alive connection, return its JSON response."""
+    body = b"" if payload is None else json.dumps(payload).encode()
+    writer.write(f"{method} {path} HTTP/1.1\r\n".encode() +
+                 b"Host: localhost\r\nContent-Type: application/json\r\n" +
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).decode().split(" ")[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode().split(":", 1)
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    response = json.loads(await reader.readexactly(length))
+    if status != 200:
+        raise RuntimeError(f"Server error {status}: {response}")
+    return response
+
+
+async def run_client(host, port, X_v, latencies, output):
+    """Send the rows of X_v one request at a time, timing each of them."""
+    reader, writer = await asyncio.open_connection(host, port)
+    for x in X_v:
+        st = time.perf_counter()
+        await send(reader, writer, "POST", "/predict",
+                   {"X": [x.tolist()], "output": output})
+        latencies.append(time.perf_counter() - st)
+    writer.close()
+
+
+async def run(host, port, n_requests, concurrency, n_unique, output, seed):
+    """Run the load, return the latencies and the total duration."""
+    reader, writer = await asyncio.open_connection(host, port)
+    info = await send(reader, writer, "GET", "/info")
+    writer.close()
+
+    # Random inputs within the training bounds, some of them repeated
+    rng = np.random.RandomState(seed)
+    lb, ub = np.array(info["lb"]), np.array(info["ub"])
+    X_u = lb + (ub - lb) * rng.rand(n_unique or n_requests, info["n_d"])
+    X_v = X_u[rng.randint(X_u.shape[0], size=n_requests)]
+
+    latencies = []
+    st = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(host, port, X_v[c::concurrency], latencies, output)
+        for c in range(concurrency)])
+    return np.array(latencies), time.perf_counter() - st
+
+
+def main(argv):
+    """Load the server and report its throughput and latencies."""
+    parser = argparse.ArgumentParser(prog="python -m podnn.loadgen")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--n-requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--n-unique", type=int, default=0,
+                        help="distinct inputs, all by default")
+    parser.add_argument("--output", default="v", choices=("v", "u"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        latencies, duration = loop.run_until_complete(
+            run(args.host, args.port, args.n_requests, args.concurrency,
+                args.n_unique, args.output, args.seed))
+    finally:
+        loop.close()
+
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+    print(f"{len(latencies)} requests in {duration:.2f}s: " +
+          f"{len(latencies) / duration:.0f} req/s, " +
+          f"p50 {p50:.2f}ms, p99 {p99:.2f}ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -28,6 +28,18 @@ class Logger(object):
 
         self.get_val_err = None
 
+        # Best validation tracking and early stopping
+        self.monitor = None
+        self.patience = None
+        self.on_best = None
+        self.best = np.inf
+        self.best_epoch = None
+        self.last = None
+        self.n_no_improvement = 0
+        # Epochs and iterations done, over all the optimization phases
+        self.n_steps = 0
+        self.stop_training = False
+
     def get_epoch_duration(self):
         now = time.time()
         edur = datetime.fromtimestamp(now - self.prev_time) \
@@ -42,35 +54,86 @@ class Logger(object):
     def set_val_err_fn(self, fn):
         self.get_val_err = fn
 
+    def set_early_stopping(self, monitor, patience=None, on_best=None):
+        """Track the lowest logged monitor value, calling on_best on each.
+
+        With a patience, the training stops after that many logs without
+        improvement.
+        """
+        self.monitor = monitor
+        self.patience = patience
+        self.on_best = on_best
+
+    def check_best(self, epoch, value):
+        """Update the best monitored value, and the stopping flag."""
+        self.last = value
+        if value < self.best:
+            self.best = value
+            self.best_epoch = epoch
+            self.n_no_improvement = 0
+            if self.on_best is not None:
+                self.on_best()
+        else:
+            self.n_no_improvement += 1
+            if self.patience is not None and \
+                    self.n_no_improvement >= self.patience:
+                self.stop_training = True
+
     def log_train_start(self):
         print("\nTraining started")
         print("================")
         self.pbar = tqdm(total=self.tf_epochs)
 
-    def log_train_epoch(self, epoch, loss, custom="", is_iter=False):
+    def log_train_epoch(self, epoch, loss, custom="", is_iter=False,
+                        is_last=False):
+        """Count an epoch, validated every frequency and on the last one.
+
+        Return whether it has been validated.
+        """
         self.pbar.update(1)
         self.pbar.set_description(f"L: {loss:.4e}")
-
-        if epoch % self.frequency == 0:
-            logs = {"L": loss, **self.get_val_err()}
-            if self.logs_keys is None:
-                self.logs_keys = list(logs.keys())
-            logs_values = [logs[x] for x in self.logs_keys]
-
-            logs_message = ""
-            for i, key in enumerate(self.logs_keys):
-                if i >= len(logs_values) - 2:
-                    logs_message += f" {key}: {logs_values[i]:.4f}"
-                else:
-                    logs_message += f" {key}: {logs_values[i]:.3e}"
-
-            name = 'nt_epoch' if is_iter else '#'
-            message = f"{name}: {epoch:6d} " + \
-                      logs_message + custom
-            self.pbar.write(message)
-
-            self.epochs.append(epoch)
-            self.logs.append(logs_values)
+        self.n_steps += 1
+
+        if epoch % self.frequency == 0 or is_last:
+            self.log_train_val(epoch, loss, custom, is_iter)
+            return True
+        return False
+
+    def log_train_epochs(self, epoch, losses, is_last=False):
+        """Log a run of epochs ending at epoch, from its losses history."""
+        self.pbar.update(len(losses) - 1)
+        self.n_steps += len(losses) - 1
+        return self.log_train_epoch(epoch, losses[-1], is_last=is_last)
+
+    def log_train_val(self, epoch, loss, custom="", is_iter=False):
+        """Validate the current state, logged at the last step done."""
+        logs = {"L": loss, **self.get_val_err()}
+        if self.logs_keys is None:
+            self.logs_keys = list(logs.keys())
+        logs_values = [logs[x] for x in self.logs_keys]
+
+        logs_message = ""
+        for i, key in enumerate(self.logs_keys):
+            if i >= len(logs_values) - 2:
+                logs_message += f" {key}: {logs_values[i]:.4f}"
+            else:
+                logs_message += f" {key}: {logs_values[i]:.3e}"
+
+        name = 'nt_epoch' if is_iter else '#'
+        message = f"{name}: {epoch:6d} " + \
+                  logs_message + custom
+        self.pbar.write(message)
+
+        # Over all the phases, to keep the logs' epochs increasing
+        self.epochs.append(self.n_steps - 1)
+        self.logs.append(logs_values)
+
+        if self.monitor is not None:
+            self.check_best(self.n_steps - 1, float(logs[self.monitor]))
+
+    def is_best_restorable(self):
+        """Whether an earlier logged state is better than the last one."""
+        return self.last is not None and self.best < self.last
 
     def log_train_opt(self, name):
         print(f"-- Starting {name} optimization --")
@@ -80,6 +143,12 @@ class Logger(object):
         print("==================")
         print(f"Training finished (epoch {epoch}): " +
               f"duration = {self.get_elapsed()}  " + custom)
+        if self.best_epoch is not None:
+            print(f"Best {self.monitor} = {self.best:.4e} " +
+                  f"at epoch {self.best_epoch}")
+            if self.is_best_restorable():
+                print(f"Restored, the last {self.monitor} being " +
+                      f"{self.last:.4e}")
 
     def get_logs(self):
         epochs = np.array(self.epochs)[:, None]
@@ -0,0 +1,160 @@
+"""Module declaring mergeable moments accumulators."""
+
+import numpy as np
+from numba import config
+
+from .acceleration import welford_update, welford_merge
+
+
+class Moments:
+    """Pointwise count, mean and M2 of samples, updated in a stable way.
+
+    M2 is the sum of squared deviations to the mean (Welford), and two
+    sets of moments can be merged exactly (Chan et al.). Partial moments
+    from threads, processes or files can thus be freely combined.
+    """
+
+    def __init__(self, shape, dtype="float64", minmax=False):
+        self.shape = tuple(shape)
+        size = int(np.prod(self.shape))
+        self.n = 0
+        self.mean = np.zeros((size,), dtype=dtype)
+        self.M2 = np.zeros((size,), dtype=dtype)
+        # Empty arrays when the extrema aren't tracked
+        n_minmax = size if minmax else 0
+        self.U_min = np.full((n_minmax,), np.inf, dtype=dtype)
+        self.U_max = np.full((n_minmax,), -np.inf, dtype=dtype)
+
+    def update(self, U):
+        """Add one sample U, of the accumulator's shape."""
+        U = np.ascontiguousarray(U).reshape(-1)
+        self.n = welford_update(self.n, self.mean, self.M2,
+                                self.U_min, self.U_max, U)
+        return self
+
+    def merge(self, other):
+        """Merge the moments of another accumulator into this one."""
+        self.n = welford_merge(self.n, self.mean, self.M2,
+                               self.U_min, self.U_max,
+                               other.n, other.mean, other.M2,
+                               other.U_min, other.U_max)
+        return self
+
+    def get_partials(self, n_chunks=None):
+        """Return empty per-chunk moments, for parallel kernels."""
+        if n_chunks is None:
+            n_chunks = config.NUMBA_NUM_THREADS
+        counts = np.zeros((n_chunks,), dtype=np.int64)
+        means = np.zeros((n_chunks, self.mean.shape[0]), dtype=self.mean.dtype)
+        M2s = np.zeros_like(means)
+        U_mins = np.full((n_chunks, self.U_min.shape[0]), np.inf,
+                         dtype=self.mean.dtype)
+        U_maxs = np.full_like(U_mins, -np.inf)
+        return counts, means, M2s, U_mins, U_maxs
+
+    def merge_partials(self, partials):
+        """Merge per-chunk moments, as returned by get_partials()."""
+        for n, mean, M2, U_min, U_max in zip(*partials):
+            self.n = welford_merge(self.n, self.mean, self.M2,
+                                   self.U_min, self.U_max,
+                                   n, mean, M2, U_min, U_max)
+        return self
+
+    def get_mean(self):
+        """Return the mean of the samples."""
+        return self.mean.reshape(self.shape)
+
+    def get_std(self):
+        """Return the (unbiased) standard deviation of the samples."""
+        if self.n < 2:
+            return np.zeros(self.shape, dtype=self.mean.dtype)
+        return np.sqrt(self.M2 / (self.n - 1)).reshape(self.shape)
+
+    def get_min(self):
+        """Return the pointwise minimum of the samples, if tracked."""
+        return self.U_min.reshape(self.shape)
+
+    def get_max(self):
+        """Return the pointwise maximum of the samples, if tracked."""
+        return self.U_max.reshape(self.shape)
+
+    def save(self, path):
+        """Save the moments to a .npz file."""
+        np.savez(path, shape=self.shape, n=self.n, mean=self.mean,
+                 M2=self.M2, U_min=self.U_min, U_max=self.U_max)
+
+    @classmethod
+    def load(cls, path):
+        """Load moments saved with save()."""
+        with np.load(path) as data:
+            moments = cls(data["shape"], dtype=data["mean"].dtype)
+            moments.n = int(data["n"])
+            moments.mean, moments.M2 = data["mean"], data["M2"]
+            moments.U_min, moments.U_max = data["U_min"], data["U_max"]
+        return moments
+
+
+class ReducedMoments:
+    """Mean and covariance of POD coefficients, accumulated by batches.
+
+    The moments are kept per time step, over samples of (n_t, n_L)
+    coefficients (n_t = 1 without time). As the solutions are u = V.v,
+    their mean and variance follow in O(n_h * n_L^2), whatever n_s is.
+    """
+
+    def __init__(self, n_L, n_t=1):
+        self.n = 0
+        self.mean = np.zeros((n_t, n_L))
+        self.M2 = np.zeros((n_t, n_L, n_L))
+
+    def update(self, v):
+        """Add a batch of coefficients, (n_b * n_t, n_L) ordered sample-wise."""
+        n_t, n_L = self.mean.shape
+        v = v.reshape((-1, n_t, n_L))
+        n_b = v.shape[0]
+        if n_b == 0:
+            return self
+
+        # Batch mean and co-moment, (n_t, n_L, n_L)
+        mean_b = np.mean(v, axis=0)
+        v_c = v - mean_b
+        M2_b = np.matmul(v_c.transpose((1, 2, 0)), v_c.transpose((1, 0, 2)))
+        return self.combine(n_b, mean_b, M2_b)
+
+    def merge(self, other):
+        """Merge the moments of another accumulator into this one."""
+        return self.combine(other.n, other.mean, other.M2)
+
+    def combine(self, n_b, mean_b, M2_b):
+        """Pairwise (Chan et al.) combination with another set of moments."""
+        if n_b == 0:
+            return self
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.M2 += M2_b + delta[:, :, None] * delta[:, None, :] * \
+            (self.n * n_b / n)
+        self.mean += delta * (n_b / n)
+        self.n = n
+        return self
+
+    def get_cov(self):
+        """Return the (unbiased) covariance of the coefficients."""
+        if self.n < 2:
+            return np.zeros_like(self.M2)
+        return self.M2 / (self.n - 1)
+
+    def get_mean_std(self, V):
+        """Return the mean and std of the solutions V.v, both (n_h, n_t)."""
+        mean = V.dot(self.mean.T)
+
+        # Pointwise variance, rowsum((V.Cov) * V) for each time step
+        cov = self.get_cov()
+        var = np.zeros_like(mean)
+        for j in range(cov.shape[0]):
+            var[:, j] = np.sum(V.dot(cov[j]) * V, axis=1)
+        # Round-off can make the tiny variances slightly negative
+        return mean, np.sqrt(np.maximum(var, 0.))
+
+    def get_cov_rows(self, V_rows):
+        """Return the solutions covariance between the DOFs of V_rows."""
+        return np.matmul(np.matmul(V_rows, self.get_cov()), V_rows.T)
@@ -0,0 +1,189 @@
+"""Module declaring a multi-fidelity Monte Carlo estimator of the HiFi stats."""
+
+import time
+import numpy as np
+import numba as nb
+
+from .acceleration import is_batched
+from .moments import Moments
+from .sampling import sample
+from .testgenerator import save_hifi
+
+# Paired HiFi/surrogate samples of the pilot run
+MFMC_N_PILOT = 50
+# Upper bound on the number of surrogate samples
+MFMC_N_LO_MAX = 10**7
+# Samples evaluated at once, in the paired and surrogate phases
+MFMC_BATCH_SIZE = 100
+
+
+def mfmc_mean_std(model, u, mu_min, mu_max, n_budget, t_min=0, t_max=0,
+                  n_pilot=MFMC_N_PILOT, sampling="lhs", seed=None,
+                  n_s_batch=MFMC_BATCH_SIZE, dirname=None):
+    """Return the HiFi mean and std, with the surrogate as a control variate.
+
+    n_budget is the compute budget, in HiFi evaluations of u. The pilot
+    gives both costs and the correlation rho of u and its POD-NN prediction,
+    from which n HiFi and m >= n surrogate samples minimize the estimator's
+    variance (Peherstorfer et al., MFMC). E[u] and E[u^2] are then
+        E_n[u] + alpha (E_m[u_nn] - E_n[u_nn]),
+    with the pointwise optimal alpha = Cov(u, u_nn) / Var(u_nn).
+    The pilot samples are part of both the n and m ones. If the surrogate
+    isn't worth it (a predicted variance ratio >= 1 against plain Monte
+    Carlo) or the pilot used the budget up, this falls back to plain Monte
+    Carlo, alpha = 0 with the whole budget on HiFi samples.
+    """
+    mu_min, mu_max = np.array(mu_min), np.array(mu_max)
+    n_p = mu_min.shape[0]
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    # Compiling u once, and warming both models up before timing them
+    batched = is_batched(u)
+    u = nb.njit(u)
+    mu_pilot = mu_min + (mu_max - mu_min)*sample(n_pilot + 1, n_p,
+                                                 sampling, seed + 1)
+    evaluate_pairs(model, u, batched, mu_pilot[:1], t_min, t_max)
+
+    print(f"Running a {n_pilot} samples pilot")
+    paired, w_hi, w_lo = evaluate_pairs(model, u, batched, mu_pilot[1:],
+                                        t_min, t_max, n_s_batch)
+
+    # Optimal ratio m/n, from the fraction of variance explained
+    rho2 = min(get_rho2(paired, 0), get_rho2(paired, 3))
+    r = np.sqrt(w_hi * rho2 / (w_lo * max(1. - rho2, 1e-12)))
+    r = min(max(r, 1.), MFMC_N_LO_MAX)
+
+    # Splitting the whole budget, the pilot included, and the variance of
+    # the MFMC mean estimator over the plain MC one, same cost
+    n = max(2, int(n_budget * w_hi / (w_hi + r * w_lo)), n_pilot)
+    m = max(int(min(r * n, MFMC_N_LO_MAX)), n)
+    var_ratio = (1. - (1. - n / m) * rho2) * n_budget / n
+    budget_left = (n_budget - n_pilot) * w_hi - n_pilot * w_lo
+    is_mfmc = budget_left > 0 and var_ratio < 1.
+    if not is_mfmc:
+        n = m = max(n_budget, n_pilot)
+        var_ratio = n_budget / n
+    n_new, m_new = n - n_pilot, m - n_pilot
+    print(f"rho^2 = {rho2:.4f}, cost ratio {w_hi / w_lo:.1f}: " +
+          (f"{n} HiFi and {m} surrogate samples" if is_mfmc else
+           f"plain Monte Carlo with {n} HiFi samples"))
+
+    # The n HiFi samples are the first ones of the m surrogate samples
+    mu_lhs = mu_min + (mu_max - mu_min)*sample(max(m_new, 1), n_p,
+                                               sampling, seed)
+    if n_new > 0:
+        paired_new, _, _ = evaluate_pairs(model, u, batched, mu_lhs[:n_new],
+                                          t_min, t_max, n_s_batch,
+                                          with_lo=is_mfmc)
+        paired.merge(paired_new)
+
+    mean = paired.get_mean()
+    if is_mfmc:
+        # Surrogate moments of the pilot and the m_new other samples
+        U_lo_mean, U_lo_sq_mean = mean[1], mean[4]
+        if m_new > 0:
+            X_v = (model.create_inputs(mu_lhs[s:s + n_s_batch], t_min, t_max)
+                   for s in range(0, m_new, n_s_batch))
+            U_b_mean, U_b_std = model.predict_heavy(X_v)
+            U_b_mean, U_b_std = U_b_mean.reshape(-1), U_b_std.reshape(-1)
+            U_b_sq_mean = U_b_std**2 * (m_new - 1) / m_new + U_b_mean**2
+            U_lo_mean = (n_pilot * U_lo_mean + m_new * U_b_mean) / m
+            U_lo_sq_mean = (n_pilot * U_lo_sq_mean + m_new * U_b_sq_mean) / m
+
+        # Control variates on the first and second moments
+        U_mean = control_variate(paired, 0, U_lo_mean)
+        U_sq_mean = control_variate(paired, 3, U_lo_sq_mean)
+    else:
+        U_mean, U_sq_mean = mean[0], mean[3]
+    # With alpha = 0, this is the unbiased variance of the n HiFi samples
+    U_var = (U_sq_mean - U_mean**2) * n / (n - 1)
+    U_std = np.sqrt(np.maximum(U_var, 0.))
+
+    tup = model.get_u_tuple()
+    U_mean, U_std = U_mean.reshape(tup), U_std.reshape(tup)
+    HP_hifi = {}
+    HP_hifi["n_t"] = model.n_t
+    if model.has_t:
+        HP_hifi["t_min"] = t_min
+        HP_hifi["t_max"] = t_max
+    HP_hifi["mu_min"] = mu_min.tolist()
+    HP_hifi["mu_max"] = mu_max.tolist()
+    HP_hifi["method"] = "mfmc" if is_mfmc else "mc"
+    HP_hifi["n_s"] = n
+    HP_hifi["n_s_lo"] = m if is_mfmc else 0
+    HP_hifi["n_s_pilot"] = n_pilot
+    HP_hifi["n_budget"] = n_budget
+    HP_hifi["rho2"] = float(rho2)
+    HP_hifi["cost_ratio"] = float(w_hi / w_lo)
+    HP_hifi["var_ratio"] = float(var_ratio)
+    if dirname is not None:
+        print(f"Saving data to {dirname}")
+        save_hifi(dirname, U_mean, U_std, HP_hifi)
+    return U_mean, U_std, HP_hifi
+
+
+def evaluate_pairs(model, u, batched, mu_lhs, t_min, t_max,
+                   n_s_batch=MFMC_BATCH_SIZE, with_lo=True):
+    """Return the paired moments of u and the surrogate, and their costs.
+
+    For each sample, with a = u and b = u_nn, the fields
+    [a, b, a + b, a^2, b^2, a^2 + b^2] are accumulated, so that the
+    covariances come from Var(a + b) = Var(a) + Var(b) + 2 Cov(a, b).
+    Without with_lo, the surrogate isn't evaluated and b = a.
+    """
+    n_s = mu_lhs.shape[0]
+    n_t = max(model.n_t, 1)
+    n_d = mu_lhs.shape[1] + model.has_t
+    X = model.x_mesh[:, 1:].T
+
+    paired = Moments((6, model.n_h * n_t))
+    t_hi, t_lo = 0., 0.
+    for s in range(0, n_s, n_s_batch):
+        e = min(n_s, s + n_s_batch)
+        n_b = e - s
+
+        # HiFi snapshots and their POD-NN predictions
+        st = time.time()
+        X_v = np.zeros((n_b * n_t, n_d))
+        U_hi = np.zeros((model.n_h, n_b * n_t))
+        model.fill_snapshots(u, batched, n_b, X_v, U_hi, X, mu_lhs[s:e],
+                             t_min, t_max)
+        t_hi += time.time() - st
+        U_lo = U_hi
+        if with_lo:
+            st = time.time()
+            U_lo = model.predict(X_v)
+            t_lo += time.time() - st
+
+        for i in range(n_b):
+            a = U_hi[:, i * n_t:(i + 1) * n_t].reshape(-1)
+            b = U_lo[:, i * n_t:(i + 1) * n_t].reshape(-1)
+            paired.update(np.stack((a, b, a + b, a**2, b**2, a**2 + b**2)))
+    return paired, t_hi / n_s, t_lo / n_s
+
+
+def get_cov_fields(paired, k):
+    """Return Var(a), Var(b) and Cov(a, b) of the pairs at index k."""
+    var = paired.get_std()**2
+    cov = (var[k + 2] - var[k] - var[k + 1]) / 2
+    return var[k], var[k + 1], cov
+
+
+def get_rho2(paired, k):
+    """Return the fraction of the HiFi variance explained by the surrogate."""
+    var_a, var_b, cov = get_cov_fields(paired, k)
+    var_a_sum = np.sum(var_a)
+    if var_a_sum == 0.:
+        return 0.
+    explained = np.where(var_b > 0., cov**2 / np.where(var_b > 0., var_b, 1.),
+                         0.)
+    return float(min(np.sum(explained) / var_a_sum, 1.))
+
+
+def control_variate(paired, k, U_lo_mean):
+    """Return the control variate estimate of the mean of a (index k)."""
+    mean = paired.get_mean()
+    _, var_b, cov = get_cov_fields(paired, k)
+    alpha = np.where(var_b > 0., cov / np.where(var_b > 0., var_b, 1.), 0.)
+    return mean[k] + alpha * (U_lo_mean - mean[k + 1])
@@ -7,14 +7,40 @@ import tensorflow as tf
 import numpy as np
 from tqdm.auto import tqdm
 
+# L-BFGS memory, line search parameters and gradient tolerance
+LBFGS_HISTORY = 50
+LBFGS_MAX_LINE_SEARCH = 20
+LBFGS_ARMIJO = 1e-4
+LBFGS_TOL_GRAD = 1e-9
+
+# Learning rate decays, by optimizer step
+LR_SCHEDULES = ("inverse_time", "exponential")
+
+
+def get_lr_schedule(lr, decay=0., schedule="inverse_time"):
+    """Return the learning rate, decayed as lr/(1 + decay*step) or
+    lr*exp(-decay*step), or constant if decay is 0."""
+    if schedule not in LR_SCHEDULES:
+        raise ValueError(f"Unknown learning rate schedule {schedule}, " +
+                         f"expected one of {LR_SCHEDULES}.")
+    if decay == 0.:
+        return lr
+    if schedule == "exponential":
+        return tf.keras.optimizers.schedules.ExponentialDecay(
+            lr, decay_steps=1, decay_rate=np.exp(-decay))
+    return tf.keras.optimizers.schedules.InverseTimeDecay(
+        lr, decay_steps=1, decay_rate=decay)
+
 
 class NeuralNetwork:
-    def __init__(self, layers, lr, lam, model=None, lb=None, ub=None):
+    def __init__(self, layers, lr, lam, model=None, lb=None, ub=None,
+                 decay=0., lr_schedule="inverse_time"):
         # Making sure the dtype is consistent
         self.dtype = "float64"
 
         # Setting up optimizer
-        self.tf_optimizer = tf.keras.optimizers.Adam(lr)
+        self.tf_optimizer = tf.keras.optimizers.Adam(
+            get_lr_schedule(lr, decay, lr_schedule))
 
         # Descriptive Keras model
         tf.keras.backend.set_floatx(self.dtype)
@@ -36,8 +62,12 @@ class NeuralNetwork:
         self.lam = lam
         self.lb = lb
         self.ub = ub
+        # Per-output standardization of the targets
+        self.v_mean = None
+        self.v_std = None
 
         self.logger = None
+        self.best_weights = None
 
     def normalize(self, X):
         """Apply a kind of normalization to the inputs X."""
@@ -45,6 +75,29 @@ class NeuralNetwork:
             return (X - self.lb) - 0.5*(self.ub - self.lb)
         return X
 
+    def standardize(self, v):
+        """Standardize the targets v, if the scaling is set."""
+        if self.v_mean is not None:
+            return (v - self.v_mean) / self.v_std
+        return v
+
+    def destandardize(self, v):
+        """Revert the standardization of the predicted targets v."""
+        if self.v_mean is not None:
+            return v * self.v_std + self.v_mean
+        return v
+
+    def set_standardization(self, v):
+        """Set the per-output scaling from the targets v."""
+        self.v_mean = np.mean(v, axis=0)
+        self.v_std = np.std(v, axis=0)
+        # Constant outputs are only centered
+        self.v_std[self.v_std == 0.] = 1.
+
+    def save_best_weights(self):
+        """Keep a copy of the current weights, as the best ones."""
+        self.best_weights = self.model.get_weights()
+
     def regularization(self):
         l2_norms = [tf.nn.l2_loss(v) for v in self.wrap_training_variables()]
         l2_norm = tf.reduce_sum(l2_norms)
@@ -69,10 +122,14 @@ class NeuralNetwork:
         return var
 
     def tf_optimization(self, X_v, v, tf_epochs):
-        """Run the training loop."""
+        """Run the training loop, return the number of epochs done."""
         for epoch in range(tf_epochs):
             loss_value = self.tf_optimization_step(X_v, v)
-            self.logger.log_train_epoch(epoch, loss_value)
+            self.logger.log_train_epoch(epoch, loss_value,
+                                        is_last=epoch == tf_epochs - 1)
+            if self.logger.stop_training:
+                return epoch + 1
+        return tf_epochs
 
     @tf.function
     def tf_optimization_step(self, X_v, v):
@@ -82,36 +139,246 @@ class NeuralNetwork:
             zip(grads, self.wrap_training_variables()))
         return loss_value
 
-    def fit(self, X_v, v, epochs, logger):
-        """Train the model over a given dataset, and parameters."""
+    def tf_optimization_fused(self, X_v, v, tf_epochs, n_fused):
+        """Run the training loop, up to n_fused epochs per graph call.
+
+        The calls end on the logging epochs, so that the losses only go back
+        to the host (and the validation is only done) at freq boundaries,
+        and on the last epoch.
+        Return the number of epochs done.
+        """
+        freq = self.logger.frequency
+        epoch = 0
+        while epoch < tf_epochs:
+            # Up to the next logging epoch, included
+            n_steps = -epoch % freq + 1
+            n_steps = min(n_steps, n_fused, tf_epochs - epoch)
+            if n_steps == 1:
+                # Also builds the optimizer's slots, outside of the graph loop
+                losses = [self.tf_optimization_step(X_v, v)]
+            else:
+                losses = self.tf_optimization_steps(X_v, v,
+                                                    tf.constant(n_steps))
+                losses = losses.numpy()
+            epoch += n_steps
+            self.logger.log_train_epochs(epoch - 1, losses,
+                                         is_last=epoch == tf_epochs)
+            if self.logger.stop_training:
+                break
+        return epoch
+
+    @tf.function
+    def tf_optimization_steps(self, X_v, v, n_steps):
+        """Run n_steps epochs in a single graph, return the losses history."""
+        def body(i, losses):
+            loss_value = self.tf_optimization_step(X_v, v)
+            return i + 1, losses.write(i, loss_value)
+
+        losses = tf.TensorArray(self.dtype, size=n_steps)
+        _, losses = tf.while_loop(lambda i, _: i < n_steps, body,
+                                  (tf.constant(0), losses))
+        return losses.stack()
+
+    def tf_optimization_batches(self, dataset, tf_epochs):
+        """Run the training loop, one pass over the minibatches per epoch.
+
+        Return the number of epochs done.
+        """
+        for epoch in range(tf_epochs):
+            loss_sum, n_batches = 0., 0
+            for X_v_b, v_b in dataset:
+                loss_sum += self.tf_optimization_step(X_v_b, v_b)
+                n_batches += 1
+            self.logger.log_train_epoch(epoch, loss_sum / n_batches,
+                                        is_last=epoch == tf_epochs - 1)
+            if self.logger.stop_training:
+                return epoch + 1
+        return tf_epochs
+
+    def nt_optimization(self, X_v, v, nt_epochs, epoch_start=0):
+        """Run a L-BFGS optimization over the flattened weights.
+
+        The two-loop recursion gives the quasi-Newton direction, and a
+        backtracking line search the step satisfying Armijo's condition.
+        The iterations are logged by their own index, and the final iterate
+        is always validated. Return the epoch reached, as it stops early
+        once converged.
+        """
+        self.logger.log_train_opt("L-BFGS")
+        w = self.get_flat_weights()
+        loss_value, g = self.get_loss_and_flat_grad(X_v, v)
+        loss_value, g = loss_value.numpy(), g.numpy()
+        S, Y = [], []
+        epoch = epoch_start
+        # The starting point is the end of the Adam phase, validated if any
+        is_logged = epoch_start > 0
+        for it in range(nt_epochs):
+            # Approximate inverse Hessian times the gradient
+            q = g.copy()
+            alphas = []
+            for s_k, y_k in zip(reversed(S), reversed(Y)):
+                rho_k = 1. / y_k.dot(s_k)
+                alpha_k = rho_k * s_k.dot(q)
+                q -= alpha_k * y_k
+                alphas.append((rho_k, alpha_k))
+            if len(S) > 0:
+                q *= S[-1].dot(Y[-1]) / Y[-1].dot(Y[-1])
+            else:
+                q *= min(1., 1. / np.sum(np.abs(g)))
+            for (s_k, y_k), (rho_k, alpha_k) in zip(zip(S, Y),
+                                                    reversed(alphas)):
+                q += s_k * (alpha_k - rho_k * y_k.dot(q))
+            d = -q
+
+            # Not a descent direction, restarting from the gradient
+            g_d = g.dot(d)
+            if g_d >= 0.:
+                S, Y = [], []
+                d = -g * min(1., 1. / np.sum(np.abs(g)))
+                g_d = g.dot(d)
+
+            # Backtracking line search
+            step = 1.
+            for _ in range(LBFGS_MAX_LINE_SEARCH):
+                self.set_flat_weights(w + step * d)
+                loss_new, g_new = self.get_loss_and_flat_grad(X_v, v)
+                loss_new, g_new = loss_new.numpy(), g_new.numpy()
+                if loss_new <= loss_value + LBFGS_ARMIJO * step * g_d:
+                    break
+                step /= 2.
+            else:
+                # No progress possible along d
+                self.set_flat_weights(w)
+                break
+
+            # Updating the curvature pairs, if positive
+            s_k, y_k = step * d, g_new - g
+            if y_k.dot(s_k) > 1e-10:
+                S.append(s_k)
+                Y.append(y_k)
+                if len(S) > LBFGS_HISTORY:
+                    S.pop(0)
+                    Y.pop(0)
+            w, loss_value, g = w + s_k, loss_new, g_new
+
+            epoch += 1
+            is_logged = self.logger.log_train_epoch(
+                it, loss_value, is_iter=True, is_last=it == nt_epochs - 1)
+            if self.logger.stop_training or \
+                    np.max(np.abs(g)) < LBFGS_TOL_GRAD:
+                break
+
+        # Stopped early, the final iterate can still be the best one
+        if not is_logged and epoch > epoch_start:
+            self.logger.log_train_val(epoch - epoch_start - 1, loss_value,
+                                      is_iter=True)
+        return epoch
+
+    @tf.function
+    def get_loss_and_flat_grad(self, X_v, v):
+        """Return the loss and its gradient, as a single flat vector."""
+        loss_value, grads = self.grad(X_v, v)
+        return loss_value, tf.concat([tf.reshape(g, [-1]) for g in grads], 0)
+
+    def get_flat_weights(self):
+        """Return the trainable weights, flattened in a single vector."""
+        return np.concatenate([w.numpy().reshape(-1)
+                               for w in self.wrap_training_variables()])
+
+    def set_flat_weights(self, w):
+        """Set the trainable weights from a single flat vector."""
+        s = 0
+        for var in self.wrap_training_variables():
+            e = s + int(np.prod(var.shape))
+            var.assign(w[s:e].reshape(var.shape))
+            s = e
+
+    def fit(self, X_v, v, epochs, logger, batch_size=0, shuffle_buffer=None,
+            preprocess=None, n_fused=0, nt_epochs=0, standardize=False):
+        """Train the model over a given dataset, and parameters.
+
+        With batch_size > 0, the training is done by minibatches from a
+        shuffled and prefetched tf.data pipeline, and preprocess (by default
+        normalize) is then applied to each batch of inputs. Otherwise, with
+        n_fused > 0, up to n_fused full-batch epochs run per graph call.
+        The Adam epochs can be followed by nt_epochs L-BFGS iterations.
+        With standardize, the network learns the per-output standardized v.
+        The last epoch of each phase is validated, and if the logger tracks
+        a best validation strictly lower than the last one, its weights are
+        restored.
+        """
         # Setting up logger
         self.logger = logger
         self.logger.log_train_start()
-
-        # Normalizing and preparing inputs
-        X_v = self.normalize(X_v)
-        X_v = self.tensor(X_v)
-        v = self.tensor(v)
+        self.batch_size = batch_size
+        self.best_weights = None
+        if epochs > 0 and nt_epochs > 0:
+            self.logger.log_train_opt("Adam")
+        if standardize:
+            self.set_standardization(v)
 
         # Optimizing
-        self.tf_optimization(X_v, v, epochs)
+        if self.batch_size > 0:
+            dataset = self.get_dataset(X_v, v, shuffle_buffer, preprocess)
+            epoch = self.tf_optimization_batches(dataset, epochs)
+            if nt_epochs > 0:
+                # The L-BFGS phase is full-batch
+                X_v = self.tensor((preprocess or self.normalize)(X_v))
+                v = self.tensor(self.standardize(v))
+        else:
+            # Normalizing and preparing inputs
+            X_v = self.tensor(self.normalize(X_v))
+            v = self.tensor(self.standardize(v))
+            if n_fused > 0:
+                epoch = self.tf_optimization_fused(X_v, v, epochs, n_fused)
+            else:
+                epoch = self.tf_optimization(X_v, v, epochs)
+        if nt_epochs > 0 and not self.logger.stop_training:
+            epoch = self.nt_optimization(X_v, v, nt_epochs, epoch)
+
+        # Getting back to the best validated state
+        if self.best_weights is not None and \
+                self.logger.is_best_restorable():
+            self.model.set_weights(self.best_weights)
 
-        self.logger.log_train_end(epochs)
+        self.logger.log_train_end(epoch)
+
+    def get_dataset(self, X_v, v, shuffle_buffer=None, preprocess=None):
+        """Return a shuffled, batched and prefetched dataset of (X_v, v).
+
+        Memory-mapped arrays (np.load(..., mmap_mode="r")) aren't loaded,
+        each batch is read from the disk in a fully shuffled order.
+        """
+        if preprocess is None:
+            preprocess = self.normalize
+        n = X_v.shape[0]
+
+        if isinstance(X_v, np.memmap) or isinstance(v, np.memmap):
+            def gen():
+                idx = np.random.permutation(n)
+                for s in range(0, n, self.batch_size):
+                    # Sorted indices make the reads more sequential
+                    idx_b = np.sort(idx[s:s + self.batch_size])
+                    yield X_v[idx_b], v[idx_b]
+            dataset = tf.data.Dataset.from_generator(
+                gen, (self.dtype, self.dtype),
+                (tf.TensorShape([None, X_v.shape[1]]),
+                 tf.TensorShape([None, v.shape[1]])))
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(
+                (self.tensor(X_v), self.tensor(v)))
+            # Reshuffled at each epoch, the whole dataset by default
+            dataset = dataset.shuffle(shuffle_buffer or n)
+            dataset = dataset.batch(self.batch_size)
 
-    def fetch_minibatch(self, X_v, v):
-        """Return a subset of the training set, for lower memory training."""
-        if self.batch_size < 1:
-            return self.tensor(X_v), self.tensor(v)
-        N_v = X_v.shape[0]
-        idx_v = np.random.choice(N_v, self.batch_size, replace=False)
-        X_v_batch = self.tensor(X_v[idx_v, :])
-        v_batch = self.tensor(v[idx_v, :])
-        return X_v_batch, v_batch
+        dataset = dataset.map(lambda X_v_b, v_b: (preprocess(X_v_b),
+                                                  self.standardize(v_b)))
+        return dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
     def predict(self, X):
         """Get the prediction for a new input X."""
         X = self.normalize(X)
-        return self.model(X).numpy()
+        return self.destandardize(self.model(X).numpy())
 
     def summary(self):
         """Print a summary of the TensorFlow/Keras model."""
@@ -124,7 +391,9 @@ class NeuralNetwork:
     def save_to(self, model_path, params_path):
         """Save the (trained) model and params for later use."""
         with open(params_path, "wb") as f:
-            pickle.dump((self.layers, self.lr, self.lam, self.lb, self.ub), f)
+            pickle.dump({"layers": self.layers, "lr": self.lr,
+                         "lam": self.lam, "lb": self.lb, "ub": self.ub,
+                         "v_mean": self.v_mean, "v_std": self.v_std}, f)
         tf.keras.models.save_model(self.model, model_path)
 
     @classmethod
@@ -138,7 +407,15 @@ class NeuralNetwork:
 
         print(f"Loading model from {model_path}")
         with open(params_path, "rb") as f:
-            layers, lam, lr, lb, ub = pickle.load(f)
+            params = pickle.load(f)
+        # Older params are a (layers, lr, lam, lb, ub[, v_mean, v_std]) tuple
+        if not isinstance(params, dict):
+            keys = ("layers", "lr", "lam", "lb", "ub", "v_mean", "v_std")
+            params = dict(zip(keys, params))
         print(f"Loading model params from {params_path}")
         model = tf.keras.models.load_model(model_path)
-        return cls(layers, lam, lr, model=model, lb=lb, ub=ub)
+        regnn = cls(params["layers"], params["lr"], params["lam"],
+                    model=model, lb=params["lb"], ub=params["ub"])
+        regnn.v_mean = params.get("v_mean")
+        regnn.v_std = params.get("v_std")
+        return regnn
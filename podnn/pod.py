@@ -1,69 +1,442 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 from tqdm.auto import tqdm
 
 
-def get_pod_bases(U, eps=1e-10, eps_init_step=None): 
+# Randomized SVD parameters
+RAND_N_OVERSAMPLES = 10
+RAND_N_POWER_ITERS = 2
+# Initial guess of n_L, doubled until the eps criterion is met
+RAND_RANK_INIT = 32
+# Randomized SVD is picked when n_L_guess * ratio <= min(n_h, n_st)
+RAND_RANK_RATIO = 10
+# ... and only for eps >= this, as tighter criteria need most of the
+# spectrum, which the rank doubling would reach slower than a dense SVD
+RAND_MIN_EPS = 1e-6
+
+# Method of snapshots is picked when n_h >= ratio * n_st
+GRAM_ASPECT_RATIO = 10
+# Number of DOFs rows processed at once when building/lifting from the Gram
+GRAM_BLOCK_SIZE = 4096
+
+# Number of DOFs rows read at once by the out-of-core TSQR
+TSQR_BLOCK_SIZE = 4096
+
+# Trajectories compressed at once, each SVD already using threaded BLAS
+TRAJ_POD_MAX_WORKERS = 4
+
+POD_METHODS = ("auto", "svd", "rand", "gram", "tsqr")
+
+
+def get_pod_bases(U, eps=1e-10, eps_init_step=None,
+                  method="auto", n_L_guess=RAND_RANK_INIT,
+                  n_L=None, cache_dir=None):
     if eps_init_step is not None:
-        eps_init_step = 1e-8
         print("Performing initial time-trajectory POD")
-        # Number of DOFs
-        n_h = U.shape[0]
         # Number of snapshots n_s x Number of space nodes (n_x * n_y * ...)
         n_s = U.shape[-1]
-        T_raw = []
 
-        # Init at the max it can be, n_t
-        n_L_init = U.shape[1]
-        T = np.zeros((n_h, n_L_init, n_s))
+        # Compressing the trajectories in parallel, then stacking them
+        traj_pod = TrajectoryPod(eps_init_step, method, n_L_guess)
         for k in range(n_s):
-            T_k = perform_pod(U[:, :, k], eps_init_step, verbose=False)
-            if T_k.shape[1] < n_L_init:
-                n_L_init = T_k.shape[1]
-            T[:, :n_L_init, k] = T_k[:, :n_L_init]
-
-        # Cropping the results accordingly and stacking
-        T = T[:, :n_L_init, :]
-        # Reshaping the 3d-mat into a 2d-mat
-        U = np.reshape(T, (n_h, n_s*n_L_init))
-    
-    print("Performing SVD...")
-    return perform_pod(U, eps)
-
-def perform_pod(U, eps, verbose=True):
-    # Number of DOFs
+            traj_pod.submit(U[:, :, k])
+        U = traj_pod.stack()
+
+    method = select_pod_method(U, method, n_L_guess, eps, n_L)
+    print(f"Performing SVD ({method})...")
+    return perform_pod(U, eps, method=method, n_L_guess=n_L_guess,
+                       n_L=n_L, cache_dir=cache_dir)
+
+
+def get_pod_block_bases(U, n_v, eps=1e-10, center=True, scale=True,
+                        method="auto", n_L_guess=RAND_RANK_INIT,
+                        n_L=None, cache_dir=None):
+    """Return independent POD bases for each of the n_v solution components.
+
+    The (n_h, n_L) bases V are block-diagonal, and come with the per-DOF
+    mean and scale to remove beforehand (None if not applied), as well as
+    the (row start, row end, col start, col end) ranges of each block.
+    """
     n_h = U.shape[0]
+    n_xyz = int(n_h / n_v)
+
+    def component_pod(c):
+        # Getting a centered and scaled copy of the component's snapshots
+        U_c = np.array(U[c*n_xyz:(c+1)*n_xyz])
+        U_c_mean = np.mean(U_c, axis=1)
+        if center:
+            U_c -= U_c_mean[:, None]
+        U_c_scale = np.sqrt(np.mean(U_c**2))
+        if not scale or U_c_scale == 0.:
+            U_c_scale = 1.
+        U_c /= U_c_scale
+
+        V_c = perform_pod(U_c, eps, verbose=False,
+                          method=select_pod_method(U_c, method, n_L_guess,
+                                                   eps, n_L),
+                          n_L_guess=n_L_guess, n_L=n_L, cache_dir=cache_dir)
+        return U_c_mean, U_c_scale, V_c
+
+    # Smaller independent SVDs, run in parallel
+    print(f"Performing SVD on {n_v} blocks...")
+    with ThreadPoolExecutor(n_v) as pool:
+        results = list(pool.map(component_pod, range(n_v)))
+
+    # Assembling the block-diagonal bases
+    n_L_tot = sum([V_c.shape[1] for _, _, V_c in results])
+    V = np.zeros((n_h, n_L_tot))
+    U_mean = np.zeros((n_h,))
+    U_scale = np.ones((n_h,))
+    blocks = []
+    c0 = 0
+    for c, (U_c_mean, U_c_scale, V_c) in enumerate(results):
+        r0, r1 = c*n_xyz, (c+1)*n_xyz
+        c1 = c0 + V_c.shape[1]
+        V[r0:r1, c0:c1] = V_c
+        U_mean[r0:r1] = U_c_mean
+        U_scale[r0:r1] = U_c_scale
+        blocks.append((r0, r1, c0, c1))
+        c0 = c1
+
+    return V, U_mean if center else None, U_scale if scale else None, blocks
+
+
+class TrajectoryPod:
+    """First-level POD of time-trajectories, run on a pool of threads.
+
+    Trajectories can be submitted as soon as they are produced. LAPACK
+    releases the GIL, so the threads share the inputs without any copy.
+    As the BLAS calls are themselves threaded, only a few of them run at
+    once, TRAJ_POD_MAX_WORKERS by default.
+    """
+
+    def __init__(self, eps_init_step, method="auto",
+                 n_L_guess=RAND_RANK_INIT, n_workers=None):
+        self.eps = eps_init_step
+        self.method = method
+        self.n_L_guess = n_L_guess
+        if n_workers is None:
+            n_workers = min(TRAJ_POD_MAX_WORKERS, os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(n_workers)
+        self.futures = []
+
+    def submit(self, U_k):
+        """Queue the POD of one (n_h, n_t) trajectory."""
+        method = select_pod_method(U_k, self.method, self.n_L_guess,
+                                   self.eps)
+        self.futures.append(self.pool.submit(compress_trajectory, U_k,
+                                             self.eps, method,
+                                             self.n_L_guess))
+
+    def stack(self):
+        """Return the trajectories' weighted bases, each at its own rank.
+
+        The second-level POD of the stack, done by the caller, is then the
+        POD of the trajectories truncated at eps_init_step.
+        """
+        T = [f.result() for f in self.futures]
+        self.pool.shutdown()
+        self.futures = []
+        return np.hstack(T)
+
+
+def compress_trajectory(U_k, eps, method="svd", n_L_guess=RAND_RANK_INIT):
+    """Return the POD bases of a trajectory, scaled by its singular values.
 
-    # Number of snapshots n_s x Number of time steps
-    n_st = U.shape[1]
+    As T_k^T.U_k = Sigma_k.Z_k^T, the singular values are its rows' norms.
+    """
+    T_k = perform_pod(U_k, eps, verbose=False, method=method,
+                      n_L_guess=n_L_guess)
+    sigmas = np.linalg.norm(T_k.T.dot(U_k), axis=1)
+    return T_k * sigmas
 
-    # SVD algoritm call
-    W, D, ZT = np.linalg.svd(U, full_matrices=False)
 
-    # Getting MATLAB-like orientation
-    Z = ZT.T
-    
+def select_pod_method(U, method="auto", n_L_guess=RAND_RANK_INIT, eps=None,
+                      n_L=None):
+    """Return the POD method to use on U, resolving the auto mode.
+
+    The randomized SVD is only picked when a few leading modes are
+    expected: a fixed n_L, or n_L_guess with eps >= RAND_MIN_EPS, small
+    enough against the matrix dimensions.
+    """
+    if method not in POD_METHODS:
+        raise ValueError(f"Unknown POD method {method}, " +
+                         f"expected one of {POD_METHODS}.")
+    if method != "auto":
+        return method
+
+    n_h, n_st = U.shape
+    is_tall = n_h >= GRAM_ASPECT_RATIO * n_st
+    # Tall snapshots on disk, streamed by blocks with a n_st x n_st R factor
+    if isinstance(U, np.memmap) and is_tall:
+        return "tsqr"
+    # Tall-skinny snapshots matrix, the n_st x n_st correlation is cheap
+    if is_tall:
+        return "gram"
+    # Only a few leading modes expected, no need for the full spectrum
+    if n_L is not None:
+        if n_L * RAND_RANK_RATIO <= min(U.shape):
+            return "rand"
+    elif eps is not None and eps >= RAND_MIN_EPS and \
+            n_L_guess * RAND_RANK_RATIO <= min(U.shape):
+        return "rand"
+    # Other snapshots on disk are still only read by row blocks
+    if isinstance(U, np.memmap):
+        return "gram"
+    return "svd"
+
+
+def perform_pod(U, eps, verbose=True, method="svd", n_L_guess=RAND_RANK_INIT,
+                n_L=None, cache_dir=None):
+    """Return the POD bases of U, truncated with eps or to a fixed n_L.
+
+    Whatever the method, the bases stop at the numerical rank of U, so the
+    actual n_L is V.shape[1].
+    """
+    if cache_dir is not None:
+        return perform_cached_pod(U, eps, cache_dir, verbose, method,
+                                  n_L_guess, n_L)
+
+    lambdas, sum_lambdas, lift = pod_spectrum(U, eps, verbose, method,
+                                              n_L_guess, n_L)
+
+    # Finding n_L
+    n_L = get_n_L(lambdas, sum_lambdas, eps, U.shape, n_L)
+
+    if verbose:
+        print("Contructing the reduced bases V...")
+    return lift(n_L)
+
+
+def pod_spectrum(U, eps, verbose=True, method="svd",
+                 n_L_guess=RAND_RANK_INIT, n_L=None):
+    """Return the POD eigenvalues, their total and a modes-lifting function.
+
+    lift(n) returns the n first reduced bases, only computing those.
+    """
+    if method == "rand":
+        return rand_spectrum(U, eps, n_L_guess, n_L=n_L, verbose=verbose)
+    if method == "gram":
+        return gram_spectrum(U, verbose=verbose)
+    if method == "tsqr":
+        return tsqr_spectrum(U, verbose=verbose)
+
+    # SVD algoritm call
+    W, D, _ = np.linalg.svd(U, full_matrices=False)
+
     # Storing eigenvalues and their sum
     lambdas = D**2
     sum_lambdas = np.sum(lambdas)
-    
-    # Finding n_L
-    n_L = 0
-    sum_lambdas_trunc = 0.
-    for i in range(n_st):
-        sum_lambdas_trunc += lambdas[i]
-        n_L += 1
-        if sum_lambdas_trunc/sum_lambdas >= (1 - eps):
-            break
-    
-    # Truncating according to n_L
-    lambdas_trunc = lambdas[0:n_L]
-   
+
+    # The left singular vectors already are the reduced bases
+    return lambdas, sum_lambdas, lambda n: W[:, :n]
+
+
+def get_n_L(lambdas, sum_lambdas, eps, shape, n_L=None):
+    """Return the number of modes to keep, up to the numerical rank.
+
+    A fixed n_L beyond it is clipped with a warning.
+    """
+    if n_L is None:
+        return min(find_n_L(lambdas, sum_lambdas, eps),
+                   get_numerical_rank(lambdas, shape))
+    return lift_rank(n_L, lambdas, shape)
+
+
+def find_n_L(lambdas, sum_lambdas, eps):
+    """Return the number of modes needed to retain 1 - eps of the energy."""
+    # First index where the cumulative energy ratio reaches 1 - eps
+    ratios = np.cumsum(lambdas) / sum_lambdas
+    n_L = np.searchsorted(ratios, 1 - eps) + 1
+    return int(min(n_L, lambdas.shape[0]))
+
+
+def hash_snapshots(U, block_size=TSQR_BLOCK_SIZE):
+    """Return a content hash of the snapshots matrix, read by row blocks."""
+    h = hashlib.sha1(f"{U.shape}{U.dtype}".encode())
+    for s in range(0, U.shape[0], block_size):
+        h.update(np.ascontiguousarray(U[s:s + block_size]).data)
+    return h.hexdigest()
+
+
+def perform_cached_pod(U, eps, cache_dir, verbose=True, method="svd",
+                       n_L_guess=RAND_RANK_INIT, n_L=None):
+    """Return the POD bases of U, re-truncating a cached spectrum if any.
+
+    The eigenvalues and the untruncated bases are saved once per snapshots
+    matrix, so that any other eps or n_L only costs a copy of n_L columns.
+    """
+    key = hash_snapshots(U)
+    spectrum_path = os.path.join(cache_dir, f"pod_{key}.npz")
+    W_path = os.path.join(cache_dir, f"pod_{key}_W.npy")
+
+    if os.path.exists(spectrum_path) and os.path.exists(W_path):
+        spectrum = np.load(spectrum_path)
+        lambdas, sum_lambdas = spectrum["lambdas"], spectrum["sum_lambdas"]
+        W = np.load(W_path, mmap_mode="r")
+
+        # The cached modes stop at the numerical rank, unless the
+        # (randomized) spectrum is partial and may not reach the criterion
+        if n_L is None:
+            is_valid = spectrum["is_complete"] or \
+                find_n_L(lambdas, sum_lambdas, eps) < lambdas.shape[0]
+        else:
+            is_valid = spectrum["is_complete"] or n_L <= lambdas.shape[0]
+        if is_valid:
+            if verbose:
+                print(f"Re-truncating the cached POD spectrum ({key})")
+            n_L = get_n_L(lambdas, sum_lambdas, eps, U.shape, n_L)
+            return np.array(W[:, :n_L])
+
+    lambdas, sum_lambdas, lift = pod_spectrum(U, eps, verbose, method,
+                                              n_L_guess, n_L)
+
+    # Keeping all the numerically non-zero modes
+    n_r = get_numerical_rank(lambdas, U.shape)
     if verbose:
-        print("Contructing the reduced bases V...")
-    V = np.zeros((n_h, n_L))
-    for i in tqdm(range(n_L), disable=(not verbose)):
-        V[:, i] = U.dot(Z[:, i]) / np.sqrt(lambdas_trunc[i])
-    
+        print(f"Caching the POD spectrum ({key}, {n_r} modes)")
+    W = lift(n_r)
+    np.save(W_path, W)
+    is_complete = method != "rand" or lambdas.shape[0] == min(U.shape)
+    np.savez(spectrum_path, lambdas=lambdas[:n_r], sum_lambdas=sum_lambdas,
+             is_complete=is_complete)
+
+    return W[:, :get_n_L(lambdas, sum_lambdas, eps, U.shape, n_L)]
+
+
+def get_numerical_rank(lambdas, shape):
+    """Return the number of numerically non-zero (descending) eigenvalues."""
+    if lambdas.shape[0] == 0 or lambdas[0] <= 0.:
+        return 0
+    return int(np.sum(lambdas > lambdas[0] * max(shape) *
+                      np.finfo(lambdas.dtype).eps))
+
+
+def lift_rank(n, lambdas, shape, verbose=True):
+    """Clip n to the numerical rank, beyond which modes can't be lifted."""
+    n_r = get_numerical_rank(lambdas, shape)
+    if n > n_r:
+        if verbose:
+            print(f"Only {n_r} modes out of {n} are numerically non-zero, " +
+                  "keeping those")
+        return n_r
+    return n
+
+
+def gram_matrix(U, block_size=GRAM_BLOCK_SIZE):
+    """Return the n_st x n_st correlation matrix U^T.U, built by row blocks."""
+    n_h, n_st = U.shape
+    C = np.zeros((n_st, n_st))
+    for s in range(0, n_h, block_size):
+        U_b = U[s:s + block_size]
+        # A^T.A on a single buffer is dispatched to BLAS syrk by NumPy
+        C += U_b.T.dot(U_b)
+    return C
+
+
+def lift_modes(U, Z, sigmas, block_size, verbose=True):
+    """Return the bases V = U.Z.Sigma^(-1), computed by row blocks of U."""
+    Z = Z / sigmas
+    V = np.zeros((U.shape[0], Z.shape[1]))
+    for s in tqdm(range(0, U.shape[0], block_size), disable=(not verbose)):
+        V[s:s + block_size] = np.asarray(U[s:s + block_size]).dot(Z)
     return V
 
+
+def gram_spectrum(U, block_size=GRAM_BLOCK_SIZE, verbose=True):
+    """Return the POD spectrum of U from the method of snapshots."""
+    # Eigendecomposition of the correlation matrix, in descending order
+    if verbose:
+        print("Building the correlation matrix...")
+    lambdas, Z = np.linalg.eigh(gram_matrix(U, block_size))
+    lambdas, Z = lambdas[::-1], Z[:, ::-1]
+    # Round-off can make the smallest eigenvalues slightly negative
+    lambdas = np.maximum(lambdas, 0.)
+    sum_lambdas = np.sum(lambdas)
+
+    # Lifting the modes back to the full space, V = U.Z.Lambda^(-1/2),
+    # only for the non-zero eigenvalues
+    def lift(n):
+        n = lift_rank(n, lambdas, U.shape, verbose)
+        return lift_modes(U, Z[:, :n], np.sqrt(lambdas[:n]),
+                          block_size, verbose)
+    return lambdas, sum_lambdas, lift
+
+
+def tsqr_spectrum(U, block_size=TSQR_BLOCK_SIZE, verbose=True):
+    """Return the POD spectrum of U, streamed by row blocks (out-of-core).
+
+    The memory is O((block_size + n_st) * n_st), so it's meant for tall U.
+    """
+    n_h = U.shape[0]
+
+    # Tall-skinny QR, merging the R factor of each row block with the next
+    if verbose:
+        print("Reducing the snapshots with a streamed TSQR...")
+    R = None
+    for s in tqdm(range(0, n_h, block_size), disable=(not verbose)):
+        U_b = np.asarray(U[s:s + block_size])
+        if R is not None:
+            U_b = np.vstack((R, U_b))
+        R = np.linalg.qr(U_b, mode="r")
+
+    # U = Q.R, so U and R share their singular values and right vectors
+    _, D, ZT = np.linalg.svd(R, full_matrices=False)
+    lambdas = D**2
+    sum_lambdas = np.sum(lambdas)
+
+    # Second pass to lift the modes, V = U.Z.D^(-1)
+    def lift(n):
+        n = lift_rank(n, lambdas, U.shape, verbose)
+        return lift_modes(U, ZT[:n].T, D[:n], block_size, verbose)
+    return lambdas, sum_lambdas, lift
+
+
+def rand_range_finder(U, n_r, n_power_iters=RAND_N_POWER_ITERS):
+    """Return an orthonormal basis Q of size n_r approximating range(U)."""
+    # Sketching the range with a gaussian test matrix
+    Omega = np.random.standard_normal((U.shape[1], n_r))
+    Q, _ = np.linalg.qr(U.dot(Omega))
+
+    # Power iterations, re-orthonormalized to not lose the small modes
+    for _ in range(n_power_iters):
+        Q, _ = np.linalg.qr(U.T.dot(Q))
+        Q, _ = np.linalg.qr(U.dot(Q))
+    return Q
+
+
+def rand_spectrum(U, eps, n_L_guess=RAND_RANK_INIT, n_L=None,
+                  n_oversamples=RAND_N_OVERSAMPLES,
+                  n_power_iters=RAND_N_POWER_ITERS, verbose=True):
+    """Return the leading POD spectrum of U from a randomized SVD.
+
+    The rank is doubled until the captured energy meets eps (or n_L).
+    """
+    n_max = min(U.shape)
+
+    # Total energy, ||U||_F^2, without allocating a copy of U
+    sum_lambdas = np.einsum("ij,ij->", U, U)
+
+    n_L_try = max(1, n_L_guess)
+    if n_L is not None:
+        n_L_try = max(n_L_try, n_L)
+    while True:
+        n_r = min(n_L_try + n_oversamples, n_max)
+        if verbose:
+            print(f"Randomized SVD with rank {n_r}...")
+        Q = rand_range_finder(U, n_r, n_power_iters)
+
+        # Small SVD of the projection of U onto the sketched range
+        W_B, D, _ = np.linalg.svd(Q.T.dot(U), full_matrices=False)
+        lambdas = D**2
+
+        # Growing the rank until the captured energy meets the criterion
+        if n_r == n_max or n_L is not None or \
+                np.sum(lambdas)/sum_lambdas >= (1 - eps):
+            break
+        n_L_try *= 2
+
+    return lambdas, sum_lambdas, lambda n: Q.dot(W_B[:, :n])
@@ -2,24 +2,52 @@
 
 import os
 import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 import numpy as np
 from tqdm.auto import tqdm
 from sklearn.model_selection import train_test_split
+from sklearn.neighbors import KDTree
 import numba as nb
 
-from .pod import get_pod_bases
+from .pod import get_pod_bases, get_pod_block_bases, TrajectoryPod
+from .snapshotstore import SnapshotStore
 from .handling import pack_layers
 from .logger import Logger
 from .neuralnetwork import NeuralNetwork
-from .acceleration import loop_vdot, loop_vdot_t, loop_u, loop_u_t, lhs
+from .acceleration import loop_vdot, loop_vdot_t, loop_u, loop_u_t, \
+    loop_u_batch, is_batched
 from .metrics import error_podnn
+from .moments import Moments, ReducedMoments
+from .sampling import sample
+from .inference import PodnnBundle, pack_mlp_params, reconstruct
 
 
 SETUP_DATA_NAME = "setup_data.pkl"
 TRAIN_DATA_NAME = "train_data.pkl"
 MODEL_NAME = "model.h5"
 MODEL_PARAMS_NAME = "model_params.pkl"
+BUNDLE_NAME = "model_bundle.npz"
+
+# Number of parameter samples per batch in HiFi predictions
+HIFI_BATCH_SIZE = 1000
+# Nearest mesh nodes interpolated at each probe point
+PROBE_N_NEIGHBORS = 4
+# Padded batch sizes of the compiled predictions, the last one being the
+# largest chunk, so that only these shapes are ever compiled
+PREDICT_BUCKETS = (1, 16, 256, 4096)
+
+
+def xla_function(fn, input_signature=None):
+    """Return fn as an XLA-compiled tf.function, for any TF 2 version."""
+    try:
+        return tf.function(fn, input_signature=input_signature,
+                           jit_compile=True)
+    except TypeError:
+        # TF < 2.5
+        return tf.function(fn, input_signature=input_signature,
+                           experimental_compile=True)
 
 
 class PodnnModel:
@@ -41,14 +69,27 @@ class PodnnModel:
         self.train_data_path = os.path.join(save_dir, TRAIN_DATA_NAME)
         self.model_path = os.path.join(save_dir, MODEL_NAME)
         self.model_params_path = os.path.join(save_dir, MODEL_PARAMS_NAME)
+        self.bundle_path = os.path.join(save_dir, BUNDLE_NAME)
 
         self.regnn = None
+        self.predict_fn = None
         self.n_L = None
         self.n_d = None
         self.V = None
+        # Block-wise POD per component: affine part and blocks ranges
+        self.U_mean = None
+        self.U_scale = None
+        self.pod_blocks = None
         self.ub = None
         self.lb = None
         self.layers = None
+        # Rows of the bases for the partial queries, for the current V
+        self.query_rows = {}
+        self.query_rows_V = None
+        # Probe points bases, for the current V, and the mesh spatial index
+        self.probe_bases = {}
+        self.probe_bases_V = None
+        self.mesh_tree = None
 
         self.save_setup_data()
 
@@ -59,79 +100,164 @@ class PodnnModel:
         """Return the function output, it needs to be extended."""
         raise NotImplementedError
 
-    def sample_mu(self, n_s, mu_min, mu_max):
-        """Return a LHS sampling between mu_min and mu_max of size n_s."""
-        X_lhs = lhs(n_s, mu_min.shape[0]).T
+    def sample_mu(self, n_s, mu_min, mu_max, method="lhs", seed=None,
+                  shard=None):
+        """Return a sampling between mu_min and mu_max of size n_s.
+
+        The method is "lhs", "sobol" or "halton", and the design only depends
+        on the seed: shard=(i, k) returns the i-th of k contiguous slices.
+        """
+        X_lhs = sample(n_s, mu_min.shape[0], method, seed, shard)
         mu_lhs = mu_min + (mu_max - mu_min)*X_lhs
         return mu_lhs
 
-    def generate_hifi_inputs(self, n_s, mu_min, mu_max, t_min=0, t_max=0):
+    def generate_hifi_inputs(self, n_s, mu_min, mu_max, t_min=0, t_max=0,
+                             sampling="lhs", seed=None):
         """Return large inputs to be used in a HiFi prediction task."""
-        if self.has_t:
-            t_min, t_max = np.array(t_min), np.array(t_max)
+        return np.vstack(list(self.iter_hifi_inputs(n_s, mu_min, mu_max,
+                                                    t_min, t_max,
+                                                    sampling=sampling,
+                                                    seed=seed)))
+
+    def iter_hifi_inputs(self, n_s, mu_min, mu_max, t_min=0, t_max=0,
+                         n_s_batch=HIFI_BATCH_SIZE, sampling="lhs", seed=None):
+        """Yield large HiFi inputs lazily, by batches of n_s_batch samples."""
         mu_min, mu_max = np.array(mu_min), np.array(mu_max)
 
-        mu_lhs = self.sample_mu(n_s, mu_min, mu_max)
-
-        n_st = n_s
-        n_d = mu_min.shape[0]
-        if self.has_t:
-            n_st *= self.n_t
-            n_d += 1
-
-        X_v = np.zeros((n_st, n_d))
+        mu_lhs = self.sample_mu(n_s, mu_min, mu_max, sampling, seed)
 
-        if self.has_t:
-            # Creating the time steps
-            t = np.linspace(t_min, t_max, self.n_t)
-            tT = t.reshape((self.n_t, 1))
+        for s in range(0, n_s, n_s_batch):
+            yield self.create_inputs(mu_lhs[s:s + n_s_batch], t_min, t_max)
 
-            for i in tqdm(range(n_s)):
-                # Getting the snapshot times indices
-                s = self.n_t * i
-                e = self.n_t * (i + 1)
+    def create_inputs(self, mu_lhs, t_min=0, t_max=0):
+        """Return the regression inputs of parameters, (t, mu) if has_t."""
+        if not self.has_t:
+            return mu_lhs
 
-                # Setting the regression inputs (t, mu)
-                X_v[s:e, :] = np.hstack((tT, np.ones_like(tT)*mu_lhs[i]))
-        else:
-            for i in tqdm(range(n_s)):
-                X_v[i, :] = mu_lhs[i]
+        # Setting the regression inputs (t, mu), n_t rows per sample
+        t = np.linspace(t_min, t_max, self.n_t)
+        X_v = np.zeros((mu_lhs.shape[0] * self.n_t, mu_lhs.shape[1] + 1))
+        X_v[:, 0] = np.tile(t, mu_lhs.shape[0])
+        X_v[:, 1:] = np.repeat(mu_lhs, self.n_t, axis=0)
         return X_v
 
     def split_dataset(self, X_v, v, test_size):
         if not self.has_t:
+            if isinstance(X_v, np.memmap) or isinstance(v, np.memmap):
+                # Contiguous slices stay on disk, the inputs being sampled
+                # (LHS, Sobol or Halton) over the whole domain already
+                n_train = X_v.shape[0] - int(np.ceil(test_size*X_v.shape[0]))
+                return X_v[:n_train], X_v[n_train:], v[:n_train], v[n_train:]
             # Randomly splitting the dataset (X_v, v)
             return train_test_split(X_v, v, test_size=test_size)
 
-        n_st_train = int((1. - test_size) * X_v.shape[0])
+        # Splitting on whole time-trajectories
+        n_s = int(X_v.shape[0] / self.n_t)
+        n_st_train = int((1. - test_size) * n_s) * self.n_t
         X_v_train, v_train = X_v[:n_st_train, :], v[:n_st_train, :]
         X_v_val, v_val = X_v[n_st_train:, :], v[n_st_train:, :]
         return X_v_train, X_v_val, v_train, v_val
 
     def create_snapshots(self, n_s, n_st, n_d, n_h, u, mu_lhs,
-                         t_min=0, t_max=0):
+                         t_min=0, t_max=0, store_path=None, n_s_block=32,
+                         traj_pod=None):
         """Create a generated snapshots matrix and inputs for benchmarks."""
-        n_xyz = self.x_mesh.shape[0]
-
         # Numba-ifying the function
+        batched = is_batched(u)
         u = nb.njit(u)
 
         # Getting the nodes coordinates
         X = self.x_mesh[:, 1:].T
 
+        if store_path is not None or traj_pod is not None:
+            if store_path is not None:
+                U = SnapshotStore(store_path, n_h, n_st).U
+            else:
+                U = np.zeros((n_h, n_st))
+            return self.create_snapshots_blocks(U, n_s, n_d, n_h, u, X,
+                                                mu_lhs, t_min, t_max,
+                                                n_s_block, traj_pod, batched)
+
         # Declaring the common output arrays
         X_v = np.zeros((n_st, n_d))
         U = np.zeros((n_h, n_st))
 
+        U_struct = self.fill_snapshots(u, batched, n_s, X_v, U, X, mu_lhs,
+                                       t_min, t_max)
+        return X_v, U, U_struct
+
+    def fill_snapshots(self, u, batched, n_s, X_v, U, X, mu_lhs,
+                       t_min, t_max):
+        """Fill the inputs X_v and snapshots U in place, return U_struct."""
+        n_xyz = self.x_mesh.shape[0]
+        n_h = U.shape[0]
+
+        if batched:
+            n_t = max(self.n_t, 1)
+            t = np.zeros((1,))
+            if self.has_t:
+                # Setting the regression inputs (t, mu), n_t rows per sample
+                t = np.linspace(t_min, t_max, n_t)
+                X_v[:, 0] = np.tile(t, n_s)
+                X_v[:, 1:] = np.repeat(mu_lhs, n_t, axis=0)
+            else:
+                X_v[:] = mu_lhs
+            loop_u_batch(u, n_s, n_t, nb.config.NUMBA_NUM_THREADS,
+                         U, X, mu_lhs, t)
+            if self.has_t:
+                # (n_h, n_s * n_t) -> (n_h, n_t, n_s), as a view
+                return np.transpose(U.reshape((n_h, n_s, n_t)), (0, 2, 1))
+            return U
+
         if self.has_t:
             U_struct = np.zeros((n_h, self.n_t, n_s))
-            return loop_u_t(u, n_s, self.n_t, self.n_v, n_xyz, n_h,
-                            X_v, U, U_struct, X, mu_lhs, t_min, t_max)
+            loop_u_t(u, n_s, self.n_t, self.n_v, n_xyz, n_h,
+                     X_v, U, U_struct, X, mu_lhs, t_min, t_max)
+            return U_struct
+
+        loop_u(u, n_s, n_h, X_v, U, X, mu_lhs)
+        return U
+
+    def create_snapshots_blocks(self, U, n_s, n_d, n_h, u, X, mu_lhs,
+                                t_min, t_max, n_s_block, traj_pod=None,
+                                batched=False):
+        """Create the snapshots by blocks, written straight into U.
+
+        U can be an on-disk memmap, and each time-trajectory can be handed
+        to a TrajectoryPod as soon as it is generated.
+        """
+        n_t = max(self.n_t, 1)
+
+        X_v = np.zeros((n_s * n_t, n_d))
+        for s in tqdm(range(0, n_s, n_s_block)):
+            e = min(n_s, s + n_s_block)
+            n_b = e - s
+
+            # Only a block of snapshots is held in memory
+            X_v_b = np.zeros((n_b * n_t, n_d))
+            U_b = np.zeros((n_h, n_b * n_t))
+            U_struct_b = self.fill_snapshots(u, batched, n_b, X_v_b, U_b, X,
+                                             mu_lhs[s:e], t_min, t_max)
+            if traj_pod is not None:
+                for k in range(n_b):
+                    traj_pod.submit(U_struct_b[:, :, k])
+
+            X_v[s * n_t:e * n_t] = X_v_b
+            U[:, s * n_t:e * n_t] = U_b
+        if isinstance(U, np.memmap):
+            U.flush()
 
-        return loop_u(u, n_s, n_h, X_v, U, X, mu_lhs)
+        if self.has_t:
+            # (n_h, n_s * n_t) -> (n_h, n_t, n_s), as a view
+            U_struct = np.transpose(U.reshape((n_h, n_s, self.n_t)),
+                                    (0, 2, 1))
+            return X_v, U, U_struct
+        return X_v, U, U
 
     def convert_dataset(self, u_mesh, X_v, train_val_test, eps, eps_init=None,
-                        use_cache=False):
+                        use_cache=False, pod_method="auto", store_path=None,
+                        n_L=None, pod_cache=False,
+                        pod_blocks=False, pod_center=True, pod_scale=True):
         """Convert spatial mesh/solution to usable inputs/snapshot matrix."""
         if use_cache and os.path.exists(self.train_data_path):
             return self.load_train_data()
@@ -141,32 +267,56 @@ class PodnnModel:
         n_s = X_v.shape[0]
 
         # U = u_mesh.reshape(n_h, n_st)
-        # Reshaping manually
-        U = np.zeros((n_h, n_s))
+        # Reshaping manually, possibly directly into an on-disk store
+        if store_path is not None:
+            U = SnapshotStore(store_path, n_h, n_s).U
+        else:
+            U = np.zeros((n_h, n_s))
         for i in range(n_s):
             st = self.n_xyz * i
             en = self.n_xyz * (i + 1)
             U[:, i] = u_mesh[st:en, :].T.reshape((n_h,))
 
+        return self.convert_snapshots(X_v, U, train_val_test, eps, eps_init,
+                                      pod_method, n_L, pod_cache,
+                                      pod_blocks, pod_center, pod_scale)
+
+    def convert_snapshots(self, X_v, U, train_val_test, eps, eps_init=None,
+                          pod_method="auto", n_L=None, pod_cache=False,
+                          pod_blocks=False, pod_center=True, pod_scale=True):
+        """Get the POD bases and the reduced dataset of given snapshots.
+
+        U is (n_h, n_st), e.g. as loaded from a SolverPool run, and X_v the
+        matching inputs (see create_inputs()).
+        """
+        n_h, n_s = U.shape
+
         # Getting the POD bases, with u_L(x, mu) = V.u_rb(x, mu) ~= u_h(x, mu)
         # u_rb are the reduced coefficients we're looking for
-        if eps_init is not None and self.has_t:
+        cache_dir = self.save_dir if pod_cache else None
+        if pod_blocks:
+            self.set_pod_block_bases(U, eps, eps_init, pod_center, pod_scale,
+                                     pod_method, n_L, cache_dir)
+        elif eps_init is not None and self.has_t:
             # Never tested
             n_s = int(n_s / self.n_t)
             self.V = get_pod_bases(U.reshape((n_h, self.n_t, n_s)),
-                                   eps, eps_init_step=eps_init)
+                                   eps, eps_init_step=eps_init,
+                                   method=pod_method, n_L=n_L,
+                                   cache_dir=cache_dir)
         else:
-            self.V = get_pod_bases(U, eps)
+            self.V = get_pod_bases(U, eps, method=pod_method, n_L=n_L,
+                                   cache_dir=cache_dir)
 
         # Projecting
-        v = (self.V.T.dot(U)).T
+        v = self.project(U)
 
         # Randomly splitting the dataset (X_v, v)
         X_v_train, X_v_test, v_train, v_test = \
             self.split_dataset(X_v, v, train_val_test[2])
 
         # Creating the validation snapshots matrix
-        U_test = self.V.dot(v_test.T)
+        U_test = self.reconstruct(v_test)
 
         self.save_train_data(X_v, X_v_train, v_train, X_v_test, v_test, U_test)
 
@@ -175,7 +325,10 @@ class PodnnModel:
     def generate_dataset(self, u, mu_min, mu_max, n_s,
                          train_val_test, eps, eps_init=None,
                          t_min=0, t_max=0,
-                         use_cache=False):
+                         use_cache=False, pod_method="auto",
+                         store_path=None, n_L=None, pod_cache=False,
+                         pod_blocks=False, pod_center=True, pod_scale=True,
+                         sampling="lhs", seed=None):
         """Generate a training dataset for benchmark problems."""
         if use_cache:
             return self.load_train_data()
@@ -197,53 +350,111 @@ class PodnnModel:
         # Number of DOFs
         n_h = self.n_v * self.x_mesh.shape[0]
 
-        # LHS sampling (first uniform, then perturbated)
-        print("Doing the LHS sampling on the non-spatial params...")
-        mu_lhs = self.sample_mu(n_s, mu_min, mu_max)
+        # Sampling the non-spatial params (LHS, Sobol or Halton)
+        print(f"Doing the {sampling} sampling on the non-spatial params...")
+        mu_lhs = self.sample_mu(n_s, mu_min, mu_max, sampling, seed)
+
+        # Compressing each time-trajectory as soon as it is created
+        traj_pod = None
+        if eps_init is not None and self.has_t and not pod_blocks:
+            print("Performing initial time-trajectory POD")
+            traj_pod = TrajectoryPod(eps_init, pod_method)
 
         # Creating the snapshots
         print(f"Generating {n_st} corresponding snapshots")
         X_v, U, U_struct = \
             self.create_snapshots(n_s, n_st, n_d, n_h, u, mu_lhs,
-                                  t_min, t_max)
+                                  t_min, t_max, store_path=store_path,
+                                  traj_pod=traj_pod)
 
         # Getting the POD bases, with u_L(x, mu) = V.u_rb(x, mu) ~= u_h(x, mu)
         # u_rb are the reduced coefficients we're looking for
-        if eps_init is not None:
-            self.V = get_pod_bases(U_struct, eps, eps_init_step=eps_init)
+        cache_dir = self.save_dir if pod_cache else None
+        if pod_blocks:
+            self.set_pod_block_bases(U, eps, eps_init, pod_center, pod_scale,
+                                     pod_method, n_L, cache_dir)
+        elif traj_pod is not None:
+            self.V = get_pod_bases(traj_pod.stack(), eps, method=pod_method,
+                                   n_L=n_L, cache_dir=cache_dir)
         else:
-            self.V = get_pod_bases(U, eps)
+            self.V = get_pod_bases(U, eps, method=pod_method, n_L=n_L,
+                                   cache_dir=cache_dir)
 
         # Projecting
-        v = (self.V.T.dot(U)).T
+        v = self.project(U)
 
         # Randomly splitting the dataset (X_v, v)
         X_v_train, X_v_test, v_train, v_test = \
             self.split_dataset(X_v, v, train_val_test[2])
 
         # Creating the validation snapshots matrix
-        U_test = self.V.dot(v_test.T)
+        U_test = self.reconstruct(v_test)
 
         self.save_train_data(X_v, X_v_train, v_train, X_v_test, v_test, U_test)
 
         return X_v_train, v_train, X_v_test, v_test, U_test
 
+    def set_pod_block_bases(self, U, eps, eps_init, center, scale,
+                            method, n_L, cache_dir):
+        """Compute independent, centered/scaled POD bases per component."""
+        if eps_init is not None:
+            raise ValueError("Block-wise POD doesn't support the " +
+                             "time-trajectory POD (eps_init).")
+        self.V, self.U_mean, self.U_scale, self.pod_blocks = \
+            get_pod_block_bases(U, self.n_v, eps, center, scale,
+                                method=method, n_L=n_L, cache_dir=cache_dir)
+
+    def project(self, U):
+        """Return the reduced coefficients v of the snapshots U, (n_st, n_L)."""
+        if self.pod_blocks is None:
+            return (self.V.T.dot(U)).T
+
+        v = np.zeros((U.shape[1], self.V.shape[1]))
+        for r0, r1, c0, c1 in self.pod_blocks:
+            U_c = np.asarray(U[r0:r1])
+            if self.U_mean is not None:
+                U_c = U_c - self.U_mean[r0:r1, None]
+            if self.U_scale is not None:
+                U_c = U_c / self.U_scale[r0]
+            v[:, c0:c1] = (self.V[r0:r1, c0:c1].T.dot(U_c)).T
+        return v
+
+    def reconstruct(self, v):
+        """Return the snapshots (n_h, n_st) from reduced coefficients v."""
+        return reconstruct(v, self.V, self.pod_blocks, self.U_mean,
+                           self.U_scale)
+
     def tensor(self, X):
         """Convert input into a TensorFlow Tensor with the class dtype."""
         return tf.convert_to_tensor(X, dtype=self.dtype)
 
-    def initNN(self, h_layers, lr, lam):
-        """Create the neural net model."""
+    def initNN(self, h_layers, lr, lam, decay=0., lr_schedule="inverse_time"):
+        """Create the neural net model, with a learning rate decay."""
         self.layers = pack_layers(self.n_d, h_layers, self.n_L)
-        self.regnn = NeuralNetwork(self.layers, lr, lam)
-
-    def train(self, X_v, v, epochs, train_val_test, freq=100):
-        """Train the POD-NN's regression model, and save it."""
+        self.regnn = NeuralNetwork(self.layers, lr, lam, decay=decay,
+                                   lr_schedule=lr_schedule)
+
+    def train(self, X_v, v, epochs, train_val_test, freq=100,
+              batch_size=0, shuffle_buffer=None, n_fused=0, nt_epochs=0,
+              monitor="REM_val", patience=None, standardize=True):
+        """Train the POD-NN's regression model, and save it.
+
+        batch_size > 0 trains by shuffled minibatches (see NeuralNetwork.fit),
+        streamed from the disk for memory-mapped X_v and v, and 0 keeps the
+        full-batch training, fused by n_fused epochs if > 0.
+        The epochs of Adam are followed by nt_epochs L-BFGS iterations.
+        The weights of the lowest logged monitor ("REM_val", "L_val", or None
+        to keep the last ones) are restored if lower than at the end of the
+        training, which is always validated, and the training stops after
+        patience logs without improvement. With standardize, each POD
+        coefficient is learnt standardized.
+        """
         if self.regnn is None:
             raise ValueError("Regression model isn't defined.")
+        self.predict_fn = None
 
         # Validation and logging
-        logger = Logger(epochs, freq)
+        logger = Logger(epochs + nt_epochs, freq)
         val_size = train_val_test[1] / (train_val_test[0] + train_val_test[1])
         X_v_train, X_v_val, v_train, v_val = \
             self.split_dataset(X_v, v, val_size)
@@ -257,10 +468,20 @@ class PodnnModel:
                 "RES_val": error_podnn(U_val_std, U_val_pred_std),
                 }
         logger.set_val_err_fn(get_val_err)
-
-        # Training
-        X_v_train = self.normalize(X_v_train)
-        self.regnn.fit(X_v_train, v_train, epochs, logger)
+        if monitor is not None:
+            logger.set_early_stopping(monitor, patience,
+                                      self.regnn.save_best_weights)
+
+        # Training, the minibatches being normalized on the fly
+        if batch_size > 0:
+            self.regnn.fit(X_v_train, v_train, epochs, logger,
+                           batch_size, shuffle_buffer, self.normalize,
+                           nt_epochs=nt_epochs, standardize=standardize)
+        else:
+            X_v_train = self.normalize(X_v_train)
+            self.regnn.fit(X_v_train, v_train, epochs, logger,
+                           n_fused=n_fused, nt_epochs=nt_epochs,
+                           standardize=standardize)
 
         # Saving
         self.save_model()
@@ -278,7 +499,7 @@ class PodnnModel:
         if self.has_t:
             # (n_h, n_st) -> (n_v, n_xyz, n_t, n_s)
             n_s = int(U.shape[-1] / self.n_t)
-            U_struct = np.zeros((self.n_v, U.shape[0], self.n_t, n_s))
+            U_struct = np.zeros((self.n_v, self.n_xyz, self.n_t, n_s))
             for i in range(n_s):
                 s = self.n_t * i
                 e = self.n_t * (i + 1)
@@ -310,37 +531,350 @@ class PodnnModel:
         v_pred = self.predict_v(X_v)
 
         # Retrieving the function with the predicted coefficients
-        U_pred = self.V.dot(v_pred.T)
+        U_pred = self.reconstruct(v_pred)
 
         return U_pred
 
-    def predict_heavy(self, X_v):
-        """Returns the predicted solutions, via proj coefficients (large inputs)."""
-        v_pred_hifi = self.predict_v(X_v)
+    def get_query_dofs(self, nodes=None, components=None):
+        """Return the DOFs indices of some nodes and components.
+
+        nodes are indices or a boolean mask over x_mesh, and components
+        one or several of range(n_v), all of them being taken if None.
+        """
+        if nodes is None:
+            nodes = np.arange(self.n_xyz)
+        nodes = np.asarray(nodes)
+        if nodes.dtype == bool:
+            if nodes.shape != (self.n_xyz,):
+                raise ValueError("The nodes mask must be of size n_xyz.")
+            nodes = np.flatnonzero(nodes)
+        if components is None:
+            components = np.arange(self.n_v)
+        components = np.atleast_1d(components)
+        if np.any(nodes < 0) or np.any(nodes >= self.n_xyz):
+            raise ValueError(f"Nodes indices must be in [0, {self.n_xyz}).")
+        if np.any(components < 0) or np.any(components >= self.n_v):
+            raise ValueError(f"Components must be in [0, {self.n_v}).")
+        return (components[:, None] * self.n_xyz + nodes[None, :]).reshape(-1)
+
+    def get_query_rows(self, dofs):
+        """Return the rows of V, U_mean and U_scale of dofs, cached."""
+        if self.query_rows_V is not self.V:
+            self.query_rows = {}
+            self.query_rows_V = self.V
+        key = dofs.tobytes()
+        if key not in self.query_rows:
+            # The affine parts only come with the block-wise bases
+            U_mean, U_scale = None, None
+            if self.pod_blocks is not None:
+                if self.U_mean is not None:
+                    U_mean = self.U_mean[dofs]
+                if self.U_scale is not None:
+                    U_scale = self.U_scale[dofs]
+            self.query_rows[key] = (np.ascontiguousarray(self.V[dofs]),
+                                    U_mean, U_scale)
+        return self.query_rows[key]
+
+    def select_times(self, X_v, t_idx):
+        """Return the rows of the time indices t_idx, of each sample of X_v."""
+        if t_idx is None or not self.has_t:
+            return X_v
+        t_idx = np.atleast_1d(t_idx)
+        n_s = int(X_v.shape[0] / self.n_t)
+        rows = np.arange(n_s)[:, None] * self.n_t + t_idx[None, :]
+        return X_v[rows.reshape(-1)]
+
+    def predict_at(self, X_v, nodes=None, components=None, t_idx=None):
+        """Returns the predicted solutions at some nodes and time indices.
+
+        Only the needed rows of X_v go through the network, and the
+        reconstruction is done with the (cached) k rows of V, in
+        O(k * n_L). The result is (n_c, k, n_t', n_s), or (n_c, k, n_s)
+        without time, n_c being the number of components.
+        """
+        dofs = self.get_query_dofs(nodes, components)
+        V_rows, U_mean, U_scale = self.get_query_rows(dofs)
+        n_c = self.n_v if components is None \
+            else np.atleast_1d(components).shape[0]
+
+        v_pred = self.predict_v(self.select_times(X_v, t_idx))
+        U_pred = V_rows.dot(v_pred.T)
+        if U_scale is not None:
+            U_pred *= U_scale[:, None]
+        if U_mean is not None:
+            U_pred += U_mean[:, None]
+        return self.restruct_query(U_pred, n_c, t_idx)
+
+    def restruct_query(self, U_pred, n_c, t_idx=None):
+        """Restruct the (n_c * k, n_s * n_t') predictions of a query."""
+        if self.has_t:
+            n_t = self.n_t if t_idx is None else np.atleast_1d(t_idx).shape[0]
+            n_s = int(U_pred.shape[1] / n_t)
+            return U_pred.reshape((n_c, -1, n_s, n_t)).transpose((0, 1, 3, 2))
+        return U_pred.reshape((n_c, -1, U_pred.shape[1]))
+
+    def get_mesh_tree(self):
+        """Return the KD-tree over the mesh nodes coordinates, built once."""
+        if self.mesh_tree is None:
+            self.mesh_tree = KDTree(self.x_mesh[:, 1:])
+        return self.mesh_tree
+
+    def get_probe_basis(self, points, components=None,
+                        n_neighbors=PROBE_N_NEIGHBORS):
+        """Return the bases (n_c * n_p, n_L) and mean of probe points.
+
+        The solution at each point is the inverse distance weighting of its
+        n_neighbors nearest nodes, so the weights W are folded in the bases
+        once, along with the block-wise POD affine parts. The probe sets are
+        cached by a hash of their points, components and n_neighbors.
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if points.ndim == 1:
+            points = points[:, None]
+        if points.shape[1] != self.x_mesh.shape[1] - 1:
+            raise ValueError("Probe points must have the mesh dimension, " +
+                             f"{self.x_mesh.shape[1] - 1}.")
+        if components is None:
+            components = np.arange(self.n_v)
+        components = np.atleast_1d(components)
+
+        if self.probe_bases_V is not self.V:
+            self.probe_bases = {}
+            self.probe_bases_V = self.V
+        h = hashlib.sha1(points.tobytes())
+        h.update(np.asarray(components, dtype=np.int64).tobytes())
+        h.update(str(n_neighbors).encode())
+        key = h.hexdigest()
+        if key in self.probe_bases:
+            return self.probe_bases[key]
+
+        # Inverse squared distance weights, exact on the nodes
+        n_neighbors = min(n_neighbors, self.n_xyz)
+        dist, idx = self.get_mesh_tree().query(points, k=n_neighbors)
+        on_node = dist[:, 0] == 0.
+        dist[on_node] = 1.
+        W = 1. / dist**2
+        W[on_node] = 0.
+        W[on_node, 0] = 1.
+        W /= np.sum(W, axis=1)[:, None]
+
+        # Folding the DOFs scaling into the bases, and interpolating the mean
+        n_p = points.shape[0]
+        P = np.zeros((components.shape[0] * n_p, self.V.shape[1]))
+        P_mean = None
+        for i, c in enumerate(components):
+            dofs = c * self.n_xyz + idx
+            V_c = self.V[dofs]
+            if self.pod_blocks is not None and self.U_scale is not None:
+                V_c = V_c * self.U_scale[dofs][:, :, None]
+            P[i*n_p:(i+1)*n_p] = np.einsum("pk,pkl->pl", W, V_c)
+            if self.pod_blocks is not None and self.U_mean is not None:
+                if P_mean is None:
+                    P_mean = np.zeros((P.shape[0],))
+                P_mean[i*n_p:(i+1)*n_p] = np.sum(W * self.U_mean[dofs],
+                                                 axis=1)
+
+        self.probe_bases[key] = (P, P_mean)
+        return P, P_mean
+
+    def predict_probes(self, X_v, points, components=None, t_idx=None,
+                       n_neighbors=PROBE_N_NEIGHBORS):
+        """Returns the predicted solutions at arbitrary points of the domain.
+
+        points is (n_p, n_dim), and the result (n_c, n_p, n_t', n_s), or
+        (n_c, n_p, n_s) without time, as in predict_at().
+        """
+        P, P_mean = self.get_probe_basis(points, components, n_neighbors)
+        n_c = self.n_v if components is None \
+            else np.atleast_1d(components).shape[0]
+
+        v_pred = self.predict_v(self.select_times(X_v, t_idx))
+        U_pred = P.dot(v_pred.T)
+        if P_mean is not None:
+            U_pred += P_mean[:, None]
+        return self.restruct_query(U_pred, n_c, t_idx)
+
+    def predict_heavy_at(self, X_v, nodes=None, components=None, t_idx=None,
+                         n_s_batch=HIFI_BATCH_SIZE):
+        """Returns the predicted mean and std at some nodes and time indices.
+
+        As predict_heavy() with the reduced statistics, only computed for
+        the k selected DOFs: (n_c, k, n_t') or (n_c, k) without time.
+        """
+        if isinstance(X_v, np.ndarray):
+            X_v = self.iter_batches(X_v, n_s_batch)
+        dofs = self.get_query_dofs(nodes, components)
+        V_rows, U_mean, U_scale = self.get_query_rows(dofs)
+        n_c = self.n_v if components is None \
+            else np.atleast_1d(components).shape[0]
+        n_t = max(self.n_t, 1)
+        if self.has_t and t_idx is not None:
+            n_t = np.atleast_1d(t_idx).shape[0]
+
+        moments = ReducedMoments(self.V.shape[1], n_t)
+        for X_v_b in tqdm(X_v):
+            moments.update(self.predict_v(self.select_times(X_v_b, t_idx)))
+        U_mean_pred, U_std_pred = moments.get_mean_std(V_rows)
+
+        # Applying the block-wise POD scaling and centering, if any
+        if U_scale is not None:
+            U_mean_pred *= U_scale[:, None]
+            U_std_pred *= U_scale[:, None]
+        if U_mean is not None:
+            U_mean_pred += U_mean[:, None]
+
+        tup = (n_c, -1) + ((n_t,) if self.has_t else ())
+        return U_mean_pred.reshape(tup), U_std_pred.reshape(tup)
+
+    def predict_compiled(self, X_v):
+        """Returns the predicted solutions, from a single XLA graph.
+
+        The normalization, the network and the reconstruction are fused.
+        The inputs are split in chunks of the largest bucket size, each
+        zero-padded to the next size of PREDICT_BUCKETS.
+        """
+        if self.predict_fn is None:
+            self.predict_fn = self.get_predict_fn()
+
+        n = X_v.shape[0]
+        U_pred = np.zeros((n, self.V.shape[0]))
+        n_max = PREDICT_BUCKETS[-1]
+        for s in range(0, n, n_max):
+            X_v_b = X_v[s:s + n_max]
+            n_b = X_v_b.shape[0]
+            n_pad = min([b for b in PREDICT_BUCKETS if b >= n_b])
+            X_v_pad = np.zeros((n_pad, X_v.shape[1]))
+            X_v_pad[:n_b] = X_v_b
+            U_pred[s:s + n_b] = self.predict_fn(self.tensor(X_v_pad))[:n_b]
+        return U_pred.T
+
+    def get_predict_fn(self):
+        """Return the compiled X_v -> U_pred.T function of predict_compiled."""
+        lb, ub = self.lb, self.ub
+        v_mean, v_std = self.regnn.v_mean, self.regnn.v_std
+        # The block-wise bases are zero outside their blocks
+        V = self.tensor(self.V)
+        U_mean, U_scale = None, None
+        if self.pod_blocks is not None:
+            U_mean, U_scale = self.U_mean, self.U_scale
+        model = self.regnn.model
+
+        def predict_fn(X_v):
+            if lb is not None and ub is not None:
+                X_v = (X_v - lb) - 0.5*(ub - lb)
+            v_pred = model(X_v)
+            if v_mean is not None:
+                v_pred = v_pred * v_std + v_mean
+            U_pred = tf.matmul(v_pred, V, transpose_b=True)
+            if U_scale is not None:
+                U_pred = U_pred * U_scale
+            if U_mean is not None:
+                U_pred = U_pred + U_mean
+            return U_pred
+
+        signature = [tf.TensorSpec([None, self.n_d], self.dtype)]
+        return xla_function(predict_fn, signature)
+
+    def predict_heavy(self, X_v, n_s_batch=HIFI_BATCH_SIZE, reduced=True,
+                      cov_dofs=None):
+        """Returns the predicted solutions, via proj coefficients (large inputs).
+
+        X_v can be an array or an iterable of inputs batches, such as
+        iter_hifi_inputs(). Batches are predicted in a pipeline: the network
+        inference of one batch overlaps the accumulation of the previous one.
+        """
+        if isinstance(X_v, np.ndarray):
+            X_v = self.iter_batches(X_v, n_s_batch)
+
+        moments = self.init_vdot(reduced)
+        with ThreadPoolExecutor(1) as pool:
+            acc = None
+            for X_v_b in tqdm(X_v):
+                v_b = self.predict_v(X_v_b)
+                # Waiting for the previous batch before queuing this one
+                if acc is not None:
+                    acc.result()
+                acc = pool.submit(self.accumulate_vdot, moments, v_b)
+            if acc is not None:
+                acc.result()
+
+        return self.finalize_vdot(moments, cov_dofs)
+
+    def iter_batches(self, X_v, n_s_batch):
+        """Yield batches of rows of X_v, holding n_s_batch whole samples."""
+        n_rows = n_s_batch * max(self.n_t, 1)
+        for s in range(0, X_v.shape[0], n_rows):
+            yield X_v[s:s + n_rows]
+
+    def do_vdot(self, v, reduced=True, cov_dofs=None):
+        """Return the mean and std of the solutions with coefficients v.
+
+        By default, the statistics are computed in the reduced space, from
+        the mean and covariance of v. The covariance of the solutions
+        between some DOFs indices, cov_dofs, can also be returned.
+        """
+        moments = self.accumulate_vdot(self.init_vdot(reduced), v)
+        return self.finalize_vdot(moments, cov_dofs)
+
+    def init_vdot(self, reduced=True):
+        """Return empty moments, of the coefficients or of the solutions."""
+        if reduced:
+            return ReducedMoments(self.V.shape[1], max(self.n_t, 1))
+        if self.has_t:
+            return Moments((self.n_h, self.n_t))
+        return Moments((self.n_h,))
 
-        return self.do_vdot(v_pred_hifi)
+    def accumulate_vdot(self, moments, v):
+        """Add the solutions with coefficients v to the moments."""
+        if isinstance(moments, ReducedMoments):
+            return moments.update(v)
 
-    def do_vdot(self, v):
+        # Per-thread partial moments, merged afterwards
+        partials = moments.get_partials()
         n_s = v.shape[0]
         if self.has_t:
             n_s = int(n_s / self.n_t)
-            U_tot = np.zeros((self.n_h, self.n_t))
-            U_tot_sq = np.zeros((self.n_h, self.n_t))
-            U_tot, U_tot_sq = \
-                loop_vdot_t(n_s, self.n_t, U_tot, U_tot_sq, self.V, v)
+            loop_vdot_t(n_s, self.n_t, *partials, self.V, v)
         else:
-            U_tot = np.zeros((self.n_h,))
-            U_tot_sq = np.zeros((self.n_h,))
-            U_tot, U_tot_sq = loop_vdot(n_s, U_tot, U_tot_sq, self.V, v)
-
-        # Getting the mean and std
-        U_pred_hifi_mean = U_tot / n_s
-        U_pred_hifi_std = np.sqrt((n_s*U_tot_sq - U_tot**2) / (n_s*(n_s - 1)))
-        # Making sure the std has non NaNs
-        U_pred_hifi_std = np.nan_to_num(U_pred_hifi_std)
+            loop_vdot(n_s, *partials, self.V, v)
+        return moments.merge_partials(partials)
+
+    def finalize_vdot(self, moments, cov_dofs=None):
+        """Return the mean and std from the accumulated moments."""
+        if isinstance(moments, ReducedMoments):
+            U_pred_hifi_mean, U_pred_hifi_std = moments.get_mean_std(self.V)
+            if not self.has_t:
+                U_pred_hifi_mean = U_pred_hifi_mean[:, 0]
+                U_pred_hifi_std = U_pred_hifi_std[:, 0]
+        else:
+            if cov_dofs is not None:
+                raise ValueError("Covariance requires the reduced stats.")
+            U_pred_hifi_mean = moments.get_mean()
+            U_pred_hifi_std = moments.get_std()
+
+        # Applying the block-wise POD scaling and centering, if any
+        if self.U_scale is not None:
+            U_scale = self.U_scale.reshape((-1,) + (1,) * self.has_t)
+            U_pred_hifi_mean = U_pred_hifi_mean * U_scale
+            U_pred_hifi_std = U_pred_hifi_std * U_scale
+        if self.U_mean is not None:
+            U_pred_hifi_mean = U_pred_hifi_mean + \
+                self.U_mean.reshape((-1,) + (1,) * self.has_t)
 
         tup = self.get_u_tuple()
-        return U_pred_hifi_mean.reshape(tup), U_pred_hifi_std.reshape(tup)
+        U_pred_hifi_mean = U_pred_hifi_mean.reshape(tup)
+        U_pred_hifi_std = U_pred_hifi_std.reshape(tup)
+        if cov_dofs is None:
+            return U_pred_hifi_mean, U_pred_hifi_std
+
+        # Covariance between the selected DOFs, (n_t, k, k) or (k, k)
+        cov_dofs = np.asarray(cov_dofs)
+        U_cov = moments.get_cov_rows(self.V[cov_dofs])
+        if self.U_scale is not None:
+            U_cov *= np.outer(self.U_scale[cov_dofs], self.U_scale[cov_dofs])
+        if not self.has_t:
+            U_cov = U_cov[0]
+        return U_pred_hifi_mean, U_pred_hifi_std, U_cov
 
     def load_train_data(self):
         """Load training data, such as datasets."""
@@ -354,7 +888,9 @@ class PodnnModel:
             self.V = data[2]
             self.ub = data[3]
             self.lb = data[4]
-            return data[3:]
+            if len(data) > 10:
+                self.U_mean, self.U_scale, self.pod_blocks = data[10:13]
+            return data[5:10]
 
     def save_train_data(self, X_v, X_v_train, v_train, X_v_test, v_test, U_test):
         """Save training data, such as datasets."""
@@ -366,7 +902,8 @@ class PodnnModel:
 
         with open(self.train_data_path, "wb") as f:
             pickle.dump((self.n_L, self.n_d, self.V, self.ub, self.lb,
-                         X_v_train, v_train, X_v_test, v_test, U_test), f)
+                         X_v_train, v_train, X_v_test, v_test, U_test,
+                         self.U_mean, self.U_scale, self.pod_blocks), f)
 
     def load_model(self):
         """Load the (trained) POD-NN's regression nn and params."""
@@ -377,11 +914,31 @@ class PodnnModel:
             raise FileNotFoundError("Can't find cached model params.")
 
         self.regnn = NeuralNetwork.load_from(self.model_path, self.model_params_path)
+        self.predict_fn = None
 
     def save_model(self):
         """Save the POD-NN's regression neural network and parameters."""
         self.regnn.save_to(self.model_path, self.model_params_path)
 
+    def save_bundle(self, path=None):
+        """Export the trained model to a .npz bundle, see PodnnBundle.
+
+        It predicts without TensorFlow, and is saved to save_dir by default.
+        """
+        if self.regnn is None:
+            raise ValueError("Regression model isn't defined.")
+        if path is None:
+            path = self.bundle_path
+        bundle = PodnnBundle(pack_mlp_params(self.regnn.model.get_weights()),
+                             np.array(self.regnn.layers, dtype=np.int64),
+                             self.lb, self.ub, self.V,
+                             self.regnn.v_mean, self.regnn.v_std,
+                             self.pod_blocks, self.U_mean, self.U_scale,
+                             self.n_t)
+        bundle.save(path)
+        print(f"Saved model bundle to {path}")
+        return bundle
+
     def save_setup_data(self):
         """Save setup-related data, such as n_v, x_mesh or n_t."""
         with open(self.setup_data_path, "wb") as f:
@@ -0,0 +1,220 @@
+"""Reproducible and shardable samplers of the unit hypercube."""
+
+import numpy as np
+from numba import jit, prange
+
+SAMPLING_METHODS = ("lhs", "sobol", "halton")
+
+# Sobol direction numbers from Joe & Kuo (new-joe-kuo-6.21201), (s, a, m_i)
+# for the dimensions 2 to 21, the first one being the van der Corput one
+SOBOL_DIRECTIONS = (
+    (1, 0, (1,)),
+    (2, 1, (1, 3)),
+    (3, 1, (1, 3, 1)),
+    (3, 2, (1, 1, 1)),
+    (4, 1, (1, 1, 3, 3)),
+    (4, 4, (1, 3, 5, 13)),
+    (5, 2, (1, 1, 5, 5, 17)),
+    (5, 4, (1, 1, 5, 5, 5)),
+    (5, 7, (1, 1, 7, 11, 19)),
+    (5, 11, (1, 1, 5, 1, 1)),
+    (5, 13, (1, 1, 1, 3, 11)),
+    (5, 14, (1, 3, 5, 5, 31)),
+    (6, 1, (1, 3, 3, 9, 7, 49)),
+    (6, 13, (1, 1, 1, 15, 21, 21)),
+    (6, 16, (1, 3, 1, 13, 27, 49)),
+    (6, 19, (1, 1, 1, 15, 7, 5)),
+    (6, 22, (1, 3, 1, 15, 13, 25)),
+    (6, 25, (1, 1, 5, 5, 19, 61)),
+    (7, 1, (1, 3, 7, 11, 23, 15, 103)),
+    (7, 4, (1, 3, 7, 13, 13, 15, 69)),
+)
+SOBOL_BITS = 32
+SOBOL_MAX_DIM = len(SOBOL_DIRECTIONS) + 1
+
+
+def sample(n, n_p, method="lhs", seed=None, shard=None):
+    """Return n points of [0, 1)^n_p, or the shard (i, k) of this design.
+
+    Worker i of k gets exactly the rows [i*n//k, (i+1)*n//k) of the global
+    design, which only depends on the seed (drawn from np.random if None).
+    """
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"Unknown sampling method {method}, " +
+                         f"expected one of {SAMPLING_METHODS}.")
+    if seed is None:
+        seed = np.random.randint(2**31)
+
+    s, e = 0, n
+    if shard is not None:
+        i, k = shard
+        s, e = i * n // k, (i + 1) * n // k
+
+    seed = np.uint64(seed)
+    if method == "sobol":
+        return sobol(s, e, n_p, seed)
+    if method == "halton":
+        return halton(s, e, n_p, seed)
+    return lhs_counter(n, s, e, n_p, seed)
+
+
+@jit(nopython=True, nogil=True)
+def splitmix64(x):
+    """Return the SplitMix64 mix of the uint64 x."""
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+@jit(nopython=True, nogil=True)
+def counter_uniform(seed, stream, counter):
+    """Return a uniform in [0, 1) that only depends on its arguments."""
+    key = splitmix64(seed ^ splitmix64(np.uint64(stream)))
+    x = splitmix64(key + np.uint64(counter))
+    return (x >> np.uint64(11)) * (1. / 2**53)
+
+
+@jit(nopython=True, nogil=True)
+def counter_permutation(seed, stream, n):
+    """Return a random permutation of range(n), from counter-based keys."""
+    keys = np.zeros(n)
+    for i in range(n):
+        keys[i] = counter_uniform(seed, stream, i)
+    return np.argsort(keys)
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def lhs_counter(n, s, e, n_p, seed):
+    """Return the rows s to e of a n-points LHS, thread count independent."""
+    H = np.zeros((e - s, n_p))
+    # pylint: disable=not-an-iterable
+    for j in prange(n_p):
+        # Random pairing of the strata, and jitter within them
+        order = counter_permutation(seed, 2*j, n)
+        for i in range(s, e):
+            u = counter_uniform(seed, 2*j + 1, i)
+            H[i - s, j] = (order[i] + u) / n
+    return H
+
+
+def get_sobol_directions(n_p):
+    """Return the (n_p, SOBOL_BITS) Sobol direction numbers."""
+    if n_p > SOBOL_MAX_DIM:
+        raise ValueError(f"Sobol sampling supports up to {SOBOL_MAX_DIM} " +
+                         "dimensions.")
+    V = np.zeros((n_p, SOBOL_BITS), dtype=np.uint64)
+    for k in range(SOBOL_BITS):
+        V[0, k] = 1 << (SOBOL_BITS - 1 - k)
+    for j in range(1, n_p):
+        s, a, m = SOBOL_DIRECTIONS[j - 1]
+        v = [0] * SOBOL_BITS
+        for k in range(SOBOL_BITS):
+            if k < s:
+                v[k] = m[k] << (SOBOL_BITS - 1 - k)
+            else:
+                v[k] = v[k - s] ^ (v[k - s] >> s)
+                for l in range(1, s):
+                    if (a >> (s - 1 - l)) & 1:
+                        v[k] ^= v[k - l]
+        V[j] = v
+    return V
+
+
+@jit(nopython=True, nogil=True)
+def sobol_scramble(V, seed):
+    """Apply a linear matrix scrambling to the direction numbers V."""
+    n_p, n_bits = V.shape
+    V_s = np.zeros_like(V)
+    for j in range(n_p):
+        # Random lower-triangular binary matrix L, unit diagonal
+        for r in range(n_bits):
+            row = np.uint64(1) << np.uint64(n_bits - 1 - r)
+            for c in range(r):
+                if counter_uniform(seed, j, r * n_bits + c) < 0.5:
+                    row |= np.uint64(1) << np.uint64(n_bits - 1 - c)
+            # Applying L to each direction number
+            for k in range(n_bits):
+                x = V[j, k] & row
+                parity = np.uint64(0)
+                while x:
+                    parity ^= np.uint64(1)
+                    x &= x - np.uint64(1)
+                V_s[j, k] |= parity << np.uint64(n_bits - 1 - r)
+    return V_s
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def sobol_points(s, e, V, shifts):
+    """Return the points s to e of the digital net given by V and shifts."""
+    n_p, n_bits = V.shape
+    H = np.zeros((e - s, n_p))
+    # pylint: disable=not-an-iterable
+    for i in prange(s, e):
+        for j in range(n_p):
+            # XOR of the direction numbers of the bits of i
+            x = shifts[j]
+            idx = i
+            k = 0
+            while idx > 0:
+                if idx & 1:
+                    x ^= V[j, k]
+                idx >>= 1
+                k += 1
+            H[i - s, j] = x / 2.**n_bits
+    return H
+
+
+def sobol(s, e, n_p, seed):
+    """Return the points s to e of a scrambled Sobol sequence."""
+    V = sobol_scramble(get_sobol_directions(n_p), seed)
+    # Random digital shift
+    shifts = np.zeros((n_p,), dtype=np.uint64)
+    for j in range(n_p):
+        shifts[j] = int(counter_uniform(seed, n_p + j, 0) * 2**SOBOL_BITS)
+    return sobol_points(s, e, V, shifts)
+
+
+@jit(nopython=True, nogil=True)
+def get_primes(n):
+    """Return the n first prime numbers."""
+    primes = np.zeros((n,), dtype=np.int64)
+    count = 0
+    p = 2
+    while count < n:
+        is_prime = True
+        for q in primes[:count]:
+            if p % q == 0:
+                is_prime = False
+                break
+        if is_prime:
+            primes[count] = p
+            count += 1
+        p += 1
+    return primes
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def halton(s, e, n_p, seed):
+    """Return the points s to e of a scrambled Halton sequence."""
+    bases = get_primes(n_p)
+    H = np.zeros((e - s, n_p))
+    # pylint: disable=not-an-iterable
+    for j in prange(n_p):
+        b = bases[j]
+        # Enough digits for a double precision radical inverse
+        n_digits = int(np.ceil(53 / np.log2(b)))
+        # One random digits permutation per digit position
+        perms = np.zeros((n_digits, b), dtype=np.int64)
+        for k in range(n_digits):
+            perms[k] = counter_permutation(seed, j * 64 + k, b)
+        for i in range(s, e):
+            x = 0.
+            f = 1. / b
+            idx = i
+            for k in range(n_digits):
+                x += perms[k, idx % b] * f
+                idx //= b
+                f /= b
+            H[i - s, j] = x
+    return H
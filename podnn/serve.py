@@ -0,0 +1,317 @@
+"""Module declaring a local micro-batching prediction server.
+
+python -m podnn.serve cache --port 8000
+
+POST /predict with a JSON {"X": [[...], ...]} of inputs rows (mu, and t
+if time-dependent) returns {"v": [...]} their reduced coefficients. With
+"output": "u", it returns {"u": [...]} the solutions, possibly restricted
+to some "nodes" and "components" (see PodnnModel.predict_at()).
+GET /info returns the model dimensions and inputs bounds.
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import OrderedDict
+import numpy as np
+
+from .podnnmodel import PodnnModel
+
+# Largest micro-batch, in inputs rows, and the time a request can wait
+SERVE_MAX_BATCH = 1024
+SERVE_MAX_LATENCY = 0.002
+# Cached coefficients, and the inputs quantization of their keys
+SERVE_CACHE_SIZE = 100000
+SERVE_QUANTUM = 1e-9
+# Largest accepted request body
+SERVE_MAX_BODY = 2**24
+# Reduced coefficients or solutions
+SERVE_OUTPUTS = ("v", "u")
+
+
+class LruCache:
+    """Least recently used cache, of at most size entries."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the value of key and mark it as recent, or None."""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Add or refresh an entry, evicting the least recent one if full."""
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class MicroBatcher:
+    """Coalesce the concurrent predictions into micro-batches.
+
+    The first pending row opens a batch, which is run once it holds
+    max_batch rows or after max_latency seconds. The network runs in a
+    worker thread, so that the next batch fills up in the meantime.
+    Rows already pending are awaited rather than queued again.
+    """
+
+    def __init__(self, model, max_batch=SERVE_MAX_BATCH,
+                 max_latency=SERVE_MAX_LATENCY, cache_size=SERVE_CACHE_SIZE,
+                 quantum=SERVE_QUANTUM):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.quantum = quantum
+        self.cache = LruCache(cache_size)
+        # Created by start(), in the serving event loop
+        self.queue = None
+        # Futures of the queued rows, by cache key
+        self.pending = {}
+        self.n_batches = 0
+        self.n_rows = 0
+
+    def get_key(self, x):
+        """Return the cache key of an inputs row, quantized."""
+        return np.round(x / self.quantum).astype(np.int64).tobytes()
+
+    async def predict_v(self, X_v):
+        """Return the reduced coefficients of the rows of X_v."""
+        keys = [self.get_key(x) for x in X_v]
+        v = [self.cache.get(key) for key in keys]
+
+        # Only the missing rows are queued, once even if already pending
+        loop = asyncio.get_event_loop()
+        futures = {}
+        for i, key in enumerate(keys):
+            if v[i] is not None or key in futures:
+                continue
+            future = self.pending.get(key)
+            if future is None:
+                future = loop.create_future()
+                self.pending[key] = future
+                self.queue.put_nowait((X_v[i], key, future))
+            futures[key] = future
+
+        # Shielded, as other requests may share them
+        results = await asyncio.gather(*[asyncio.shield(future)
+                                         for future in futures.values()])
+        results = dict(zip(futures, results))
+        v = [results[key] if v_i is None else v_i
+             for key, v_i in zip(keys, v)]
+        return np.array(v).reshape((len(keys), -1))
+
+    def start(self):
+        """Create the queue and schedule run(), in the running loop."""
+        self.queue = asyncio.Queue()
+        return asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """Collect and run the micro-batches, forever."""
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            X_v = np.array([x for x, _, _ in batch])
+            try:
+                v = await loop.run_in_executor(None, self.model.predict_v,
+                                               X_v)
+            except Exception as e:  # pylint: disable=broad-except
+                for _, key, future in batch:
+                    self.pending.pop(key, None)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.n_batches += 1
+            self.n_rows += len(batch)
+            for (_, key, future), v_i in zip(batch, v):
+                self.cache.put(key, v_i)
+                self.pending.pop(key, None)
+                if not future.done():
+                    future.set_result(v_i)
+
+
+class PredictionServer:
+    """Minimal HTTP/1.1 server of a PodnnModel's predictions."""
+
+    def __init__(self, model, **batcher_kwargs):
+        self.model = model
+        self.batcher = MicroBatcher(model, **batcher_kwargs)
+
+    async def predict(self, request):
+        """Return the response of a /predict request."""
+        X_v = np.array(request["X"], dtype=np.float64)
+        if X_v.ndim == 1:
+            X_v = X_v[None, :]
+        if X_v.ndim != 2 or X_v.shape[1] != self.model.n_d:
+            raise ValueError(f"X must be rows of {self.model.n_d} inputs.")
+        output = request.get("output", "v")
+        if output not in SERVE_OUTPUTS:
+            raise ValueError(f"Unknown output {output}, " +
+                             f"expected one of {SERVE_OUTPUTS}.")
+        v = await self.batcher.predict_v(X_v)
+        if output == "v":
+            return {"v": v.tolist()}
+
+        # Solutions, possibly at some DOFs only
+        dofs = self.model.get_query_dofs(request.get("nodes"),
+                                         request.get("components"))
+        V_rows, U_mean, U_scale = self.model.get_query_rows(dofs)
+        U = v.dot(V_rows.T)
+        if U_scale is not None:
+            U *= U_scale
+        if U_mean is not None:
+            U += U_mean
+        return {"u": U.tolist()}
+
+    def get_info(self):
+        """Return the model dimensions, bounds and serving stats."""
+        cache = self.batcher.cache
+        return {"n_d": self.model.n_d, "n_L": self.model.n_L,
+                "n_h": self.model.n_h, "n_v": self.model.n_v,
+                "n_t": self.model.n_t,
+                "lb": np.asarray(self.model.lb).tolist(),
+                "ub": np.asarray(self.model.ub).tolist(),
+                "n_batches": self.batcher.n_batches,
+                "n_rows": self.batcher.n_rows,
+                "cache_hits": cache.hits, "cache_misses": cache.misses}
+
+    async def handle(self, reader, writer):
+        """Serve the requests of a (keep-alive) connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, headers = \
+                        await self.read_head(reader, request_line)
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(f"Invalid Content-Length {length}.")
+                except ValueError as e:
+                    # The rest of the connection can't be parsed either
+                    await self.respond(writer, 400,
+                                       {"error": f"Malformed request: {e}"})
+                    break
+                if length > SERVE_MAX_BODY:
+                    await self.respond(writer, 413, {"error": "Too large."})
+                    break
+                body = await reader.readexactly(length)
+
+                status, response = await self.route(method, path, body)
+                await self.respond(writer, status, response)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_head(self, reader, request_line):
+        """Return the method, path and headers of a request.
+
+        Raise a ValueError if they are malformed.
+        """
+        method, path, _ = request_line.decode().split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, value = line.decode().split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        return method, path, headers
+
+    async def route(self, method, path, body):
+        """Return the status and JSON response of a request."""
+        if method == "GET" and path == "/info":
+            return 200, self.get_info()
+        if method == "POST" and path == "/predict":
+            try:
+                return 200, await self.predict(json.loads(body))
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": str(e)}
+            except Exception as e:  # pylint: disable=broad-except
+                # Model errors are reported, keeping the connection up
+                return 500, {"error": f"{type(e).__name__}: {e}"}
+        return 404, {"error": f"Unknown route {method} {path}."}
+
+    async def respond(self, writer, status, response):
+        """Write a JSON response."""
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found",
+                   413: "Payload Too Large", 500: "Internal Server Error"}
+        body = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {reasons[status]}\r\n".encode() +
+                     b"Content-Type: application/json\r\n" +
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        """Run the batcher and the server, until cancelled."""
+        batcher = self.batcher.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving predictions on http://{host}:{port}")
+        try:
+            await server.serve_forever()
+        finally:
+            batcher.cancel()
+            server.close()
+
+
+def main(argv):
+    """Load a trained model from its save_dir, and serve it."""
+    parser = argparse.ArgumentParser(prog="python -m podnn.serve")
+    parser.add_argument("save_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=SERVE_MAX_BATCH)
+    parser.add_argument("--max-latency", type=float,
+                        default=SERVE_MAX_LATENCY, help="in seconds")
+    parser.add_argument("--cache-size", type=int, default=SERVE_CACHE_SIZE)
+    parser.add_argument("--quantum", type=float, default=SERVE_QUANTUM)
+    args = parser.parse_args(argv)
+
+    model = PodnnModel.load(args.save_dir)
+    # Warming the network up before the first request
+    st = time.time()
+    model.predict_v(np.zeros((1, model.n_d)))
+    print(f"Model loaded, first prediction in {time.time() - st:.3f}s")
+
+    server = PredictionServer(model, max_batch=args.max_batch,
+                              max_latency=args.max_latency,
+                              cache_size=args.cache_size,
+                              quantum=args.quantum)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
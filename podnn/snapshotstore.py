@@ -0,0 +1,28 @@
+"""Module declaring an on-disk, memory-mapped snapshots matrix."""
+
+import os
+import numpy as np
+
+
+class SnapshotStore:
+    """Snapshots matrix U, (n_h, n_st), kept on disk in a .npy memmap."""
+
+    def __init__(self, path, n_h=None, n_st=None, dtype="float64"):
+        self.path = path
+        if n_h is None or n_st is None:
+            # Reopening an existing store
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Can't find snapshots store {path}.")
+            self.U = np.load(path, mmap_mode="r+")
+        else:
+            self.U = np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                               shape=(n_h, n_st))
+
+    @property
+    def shape(self):
+        """Return the shape of the stored snapshots matrix."""
+        return self.U.shape
+
+    def flush(self):
+        """Make sure every written block is on disk."""
+        self.U.flush()
@@ -0,0 +1,177 @@
+"""Module declaring a checkpointed pool of black-box snapshot solvers."""
+
+import os
+import asyncio
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm.auto import tqdm
+
+from .snapshotstore import SnapshotStore
+
+MU_FILE = "mu.npy"
+LOGS_DIR = "logs"
+
+
+def get_tmp_path(path):
+    """Return the temporary path of a .npy path, also ending in .npy."""
+    return path[:-len(".npy")] + ".tmp.npy"
+
+
+def save_atomic(path, U):
+    """Save U to the .npy path, only visible once entirely written."""
+    tmp_path = get_tmp_path(path)
+    with open(tmp_path, "wb") as f:
+        np.save(f, U)
+    os.replace(tmp_path, path)
+
+
+def solve_snapshot(solver, mu, path):
+    """Run solver(mu) in a worker process, and save its snapshot to path."""
+    save_atomic(path, np.asarray(solver(mu)))
+    return path
+
+
+class SolverPool:
+    """Snapshots of arbitrary solvers, computed in parallel and resumable.
+
+    Each snapshot is saved to out_dir as soon as it is done, so that an
+    interrupted run resumes by skipping the completed parameter indices.
+    A snapshot is either (n_h,) or (n_v, n_xyz[, n_t]), as u(X, t, mu) is.
+    """
+
+    def __init__(self, out_dir, n_workers=None):
+        self.out_dir = out_dir
+        self.n_workers = n_workers or os.cpu_count()
+        os.makedirs(os.path.join(out_dir, LOGS_DIR), exist_ok=True)
+
+    def get_path(self, i):
+        """Return the path of the i-th snapshot."""
+        return os.path.join(self.out_dir, f"u_{i:06d}.npy")
+
+    def get_pending(self, mu_lhs):
+        """Check mu_lhs against a previous run, return the missing indices."""
+        mu_path = os.path.join(self.out_dir, MU_FILE)
+        if os.path.exists(mu_path):
+            if not np.array_equal(np.load(mu_path), mu_lhs):
+                raise ValueError(f"{self.out_dir} holds snapshots of other " +
+                                 "parameters, use another directory.")
+        else:
+            save_atomic(mu_path, mu_lhs)
+        return [i for i in range(mu_lhs.shape[0])
+                if not os.path.exists(self.get_path(i))]
+
+    def run(self, solver, mu_lhs):
+        """Compute solver(mu) for each row of mu_lhs, on a process pool.
+
+        The solver has to be picklable, e.g. a module-level function.
+        """
+        n_s = mu_lhs.shape[0]
+        pending = self.get_pending(mu_lhs)
+        print(f"Solving {len(pending)} of {n_s} snapshots, " +
+              f"on {self.n_workers} processes")
+
+        with ProcessPoolExecutor(self.n_workers) as pool:
+            futures = [pool.submit(solve_snapshot, solver, mu_lhs[i],
+                                   self.get_path(i))
+                       for i in pending]
+            for future in tqdm(as_completed(futures), total=n_s,
+                               initial=n_s - len(pending)):
+                future.result()
+
+    def run_commands(self, command, mu_lhs, read_output=None):
+        """Run an external solver command line for each row of mu_lhs.
+
+        command is a list of arguments, formatted with i, mu and path (or a
+        callable returning them from (i, mu, path)). Without read_output,
+        the command has to write the snapshot to the .npy path itself,
+        otherwise read_output(i, mu) returns it once the command is done.
+        path is a temporary u_i.tmp.npy, so that np.save() keeps it as is,
+        renamed to u_i.npy once the command succeeded.
+        """
+        n_s = mu_lhs.shape[0]
+        pending = self.get_pending(mu_lhs)
+        print(f"Solving {len(pending)} of {n_s} snapshots, " +
+              f"with {self.n_workers} concurrent processes")
+
+        loop = asyncio.new_event_loop()
+        try:
+            failed = loop.run_until_complete(
+                self.run_commands_async(command, mu_lhs, read_output,
+                                        pending, n_s))
+        finally:
+            loop.close()
+        if len(failed) > 0:
+            raise RuntimeError(f"The solver failed for {len(failed)} " +
+                               f"snapshots {failed}, see the logs in " +
+                               f"{os.path.join(self.out_dir, LOGS_DIR)}.")
+
+    async def run_commands_async(self, command, mu_lhs, read_output,
+                                 pending, n_s):
+        """Run the commands of the pending indices, return the failed ones."""
+        semaphore = asyncio.Semaphore(self.n_workers)
+        pbar = tqdm(total=n_s, initial=n_s - len(pending))
+        failed = []
+
+        async def solve(i):
+            async with semaphore:
+                ok = await self.run_command(command, i, mu_lhs[i],
+                                            read_output)
+            if not ok:
+                failed.append(i)
+            pbar.update(1)
+
+        await asyncio.gather(*[solve(i) for i in pending])
+        pbar.close()
+        return sorted(failed)
+
+    async def run_command(self, command, i, mu, read_output):
+        """Run the solver command of the i-th snapshot, return its success."""
+        path = self.get_path(i)
+        tmp_path = get_tmp_path(path)
+        if callable(command):
+            args = command(i, mu, tmp_path)
+        else:
+            args = [arg.format(i=i, mu=mu, path=tmp_path) for arg in command]
+
+        # Keeping the solver's output aside, for debugging
+        log_path = os.path.join(self.out_dir, LOGS_DIR, f"u_{i:06d}.log")
+        with open(log_path, "wb") as log:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=log, stderr=subprocess.STDOUT)
+            returncode = await proc.wait()
+        if returncode != 0:
+            return False
+
+        # Reading/parsing the output without blocking the other runs
+        if read_output is not None:
+            loop = asyncio.get_event_loop()
+            U = await loop.run_in_executor(None, read_output, i, mu)
+            await loop.run_in_executor(None, save_atomic, path,
+                                       np.asarray(U))
+        elif os.path.exists(tmp_path):
+            os.replace(tmp_path, path)
+        else:
+            return False
+        return True
+
+    def load(self, n_h, n_t=1, store_path=None):
+        """Return the parameters and the (n_h, n_s * n_t) snapshots matrix."""
+        mu_path = os.path.join(self.out_dir, MU_FILE)
+        if not os.path.exists(mu_path):
+            raise FileNotFoundError(f"Can't find any run in {self.out_dir}.")
+        mu_lhs = np.load(mu_path)
+        n_s = mu_lhs.shape[0]
+
+        # Possibly gathering them directly into an on-disk store
+        if store_path is not None:
+            U = SnapshotStore(store_path, n_h, n_s * n_t).U
+        else:
+            U = np.zeros((n_h, n_s * n_t))
+        for i in range(n_s):
+            path = self.get_path(i)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Snapshot {i} is missing, " +
+                                        "resume the run first.")
+            U[:, i * n_t:(i + 1) * n_t] = np.load(path).reshape((n_h, n_t))
+        return mu_lhs, U
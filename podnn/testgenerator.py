@@ -3,25 +3,38 @@
 import sys
 import time
 import os
+import glob
+import threading
 import yaml
 from tqdm.auto import tqdm
 import numpy as np
 import numba as nb
-from numba import objmode, jit, prange
 
-from .acceleration import lhs
+from .acceleration import loop_moments, loop_moments_t, \
+    loop_moments_batch, is_batched
+from .moments import Moments
 from .mesh import create_linear_mesh
+from .sampling import sample
 
 X_FILE = "X.npy"
 T_FILE = "t.npy"
 U_MEAN_FILE = "u_mean.npy"
 U_STD_FILE = "u_std.npy"
 HP_FILE = "HP.txt"
+SHARD_FILE = "shard_{}_of_{}"
+# Seconds between two refreshes of the parallel progress bar
+PROGRESS_INTERVAL = 0.2
+# Samples per batch, and minimum number of batches, of the adaptive mode
+TOL_BATCH_SIZE = 100
+TOL_MIN_BATCHES = 5
 
 
 class TestGenerator:
     def __init__(self, u, n_v, n_x, n_y=0, n_z=0, n_t=0):
         self.u = u
+        # Compiled once, so that the kernels are compiled once per u too
+        self.u_jit = nb.njit(u)
+        self.batched = is_batched(u)
         self.n_v = n_v
         self.n_x = n_x
         self.n_y = n_y
@@ -51,70 +64,77 @@ class TestGenerator:
             tup += (self.n_t,)
         return (self.n_v,) + tup
 
-    def computeParallel(self, n_s, U_tot, U_tot_sq, X, t, mu_lhs):
-        n_t = self.n_t
-        u = nb.njit(self.u)
+    def computeParallel(self, n_s, moments, X, t, mu_lhs, pbar=None):
+        n_xyz = X.shape[1]
 
-        pbar = tqdm(total=n_s)
-        def bumpBar():
-            pbar.update(1)
-
-        @jit(nopython=True, parallel=True)
-        def loop_t(n_s, n_t, U_tot, U_tot_sq, X, t, mu_lhs):
-            for i in prange(n_s):
-                # Computing one snapshot
-                U = np.zeros_like(U_tot)
-                for j in prange(n_t):
-                    U[:, :, j] = u(X, t[j], mu_lhs[i, :])
-                # Building the sum and the sum of squaes
-                U_tot += U
-                U_tot_sq += U**2
-                with objmode():
-                    bumpBar()
-            return U_tot, U_tot_sq
-        
-        @jit(nopython=True, parallel=True)
-        def loop(n_s, U_tot, U_tot_sq, X, mu_lhs):
-            for i in prange(n_s):
-                # Computing one snapshot
-                U = u(X, 0, mu_lhs[i, :])
-                # Building the sum and the sum of squaes
-                U_tot += U
-                U_tot_sq += U**2
-                with objmode():
-                    bumpBar()
-            return U_tot, U_tot_sq
-
-        if self.has_t:
-            U_tot, U_tot_sq = loop_t(n_s, n_t, U_tot, U_tot_sq, X, t, mu_lhs)
-        else:
-            U_tot, U_tot_sq = loop(n_s, U_tot, U_tot_sq, X, mu_lhs)
+        # Polling the per-chunk counts, the kernels never hold the GIL
+        partials = moments.get_partials()
+        own_pbar = pbar is None
+        if own_pbar:
+            pbar = tqdm(total=n_s)
+        stop = threading.Event()
+        poller = threading.Thread(target=poll_progress,
+                                  args=(partials[0], pbar, stop))
+        poller.start()
+        try:
+            if self.batched:
+                t_b = t if self.has_t else np.zeros((1,))
+                loop_moments_batch(self.u_jit, n_s, self.n_v * n_xyz,
+                                   *partials, X, t_b, mu_lhs)
+            elif self.has_t:
+                loop_moments_t(self.u_jit, n_s, self.n_v, n_xyz, self.n_t,
+                               *partials, X, t, mu_lhs)
+            else:
+                loop_moments(self.u_jit, n_s, *partials, X, mu_lhs)
+        finally:
+            stop.set()
+            poller.join()
+            if own_pbar:
+                pbar.close()
 
-        with objmode():
-            pbar.close()
-        
-        return U_tot, U_tot_sq
+        return moments.merge_partials(partials)
 
-    def compute(self, n_s, U_tot, U_tot_sq, X, t, mu_lhs):
-        for i in tqdm(range(n_s)):
+    def compute(self, n_s, moments, X, t, mu_lhs, pbar=None):
+        if self.batched:
+            t_b = t if self.has_t else np.zeros((1,))
+            U_b = np.zeros((self.n_v * X.shape[1], t_b.shape[0]))
+        own_pbar = pbar is None
+        if own_pbar:
+            pbar = tqdm(total=n_s)
+        for i in range(n_s):
             # Computing one snapshot
-            U = np.zeros_like(U_tot)
-            if self.has_t:
+            if self.batched:
+                self.u(X, t_b, mu_lhs[i:i + 1], U_b)
+                U = U_b
+            elif self.has_t:
+                U = np.zeros(moments.shape)
                 for j in range(self.n_t):
                     U[:, :, j] = self.u(X, t[j], mu_lhs[i, :])
             else:
                 U = self.u(X, 0, mu_lhs[i, :])
 
-            # Building the sum and the sum of squaes
-            U_tot += U
-            U_tot_sq += U**2
+            # Updating the moments
+            moments.update(U)
+            pbar.update(1)
 
-        return U_tot, U_tot_sq
+        if own_pbar:
+            pbar.close()
+        return moments
 
     def generate(self, n_s, mu_min, mu_max, x_min, x_max,
                 y_min=0, y_max=0, z_min=0, z_max=0,
-                t_min=0, t_max=0, parallel=True):
-        """Generate a hifi-test solution of the problem's equation."""
+                t_min=0, t_max=0, parallel=True, dtype="float64",
+                sampling="lhs", seed=None, shard=None, checkpoint_every=None,
+                tol=None, tol_norm="l2", n_s_batch=TOL_BATCH_SIZE):
+        """Generate a hifi-test solution of the problem's equation.
+
+        With shard=(i, k), only the i-th of k slices of the samples is done,
+        and its partial moments are left for merge_shards(). They're also
+        saved every checkpoint_every samples, and a rerun resumes from them.
+        With a tol, samples are taken by batches of n_s_batch until the
+        relative standard errors of the mean and std are below it (n_s is
+        then the maximum budget).
+        """
         mu_min, mu_max = np.array(mu_min), np.array(mu_max)
 
         # Static data
@@ -140,28 +160,11 @@ class TestGenerator:
         if self.has_t:
             n_d += 1
 
-        # The sum and sum of squares recipient vectors
+        # The moments accumulator, float32 halves its memory traffic
         if self.has_t:
-            U_tot = np.zeros((self.n_v, n_xyz, self.n_t))
+            moments = Moments((self.n_v, n_xyz, self.n_t), dtype=dtype)
         else:
-            U_tot = np.zeros((self.n_v, n_xyz))
-        U_tot_sq = np.zeros_like(U_tot)
-
-        # Parameters sampling
-        X_lhs = lhs(n_s, n_p).T
-        mu_lhs = mu_min + (mu_max - mu_min)*X_lhs
-
-        # Going through the snapshots one by one without saving them
-        if parallel:
-            U_tot, U_tot_sq = self.computeParallel(n_s, U_tot, U_tot_sq, X, t, mu_lhs)
-        else:
-            U_tot, U_tot_sq = self.compute(n_s, U_tot, U_tot_sq, X, t, mu_lhs)
-
-        # Recreating the mean and the std
-        U_test_mean = U_tot / n_s
-        U_test_std = np.sqrt((n_s*U_tot_sq - U_tot**2) / (n_s*(n_s - 1)))
-        # Making sure the std has non NaNs
-        U_test_std = np.nan_to_num(U_test_std)
+            moments = Moments((self.n_v, n_xyz), dtype=dtype)
 
         # Reshaping
         X_out = []
@@ -170,19 +173,12 @@ class TestGenerator:
             X_out.append(X[1].reshape(self.get_x_tuple()))
             if self.has_z:
                 X_out.append(X[2].reshape(self.get_x_tuple()))
-        # U_test_mean = np.reshape(U_test_mean, self.get_u_tuple())
-        # U_test_std = np.reshape(U_test_std, self.get_u_tuple())
 
-        # print(U_test_mean)
-        # print(U_test_std)
-
-        dirname = "data" 
+        dirname = "data"
         print(f"Saving data to {dirname}")
         np.save(os.path.join(dirname, X_FILE), X_out)
         if self.has_t:
             np.save(os.path.join(dirname, T_FILE), t)
-        np.save(os.path.join(dirname, U_MEAN_FILE), U_test_mean)
-        np.save(os.path.join(dirname, U_STD_FILE), U_test_std)
 
         # Store the HiFi hyperparams
         HP_hifi = {}
@@ -204,5 +200,217 @@ class TestGenerator:
         HP_hifi["mu_min"] = mu_min.tolist()
         HP_hifi["mu_max"] = mu_max.tolist()
         HP_hifi["n_s"] = n_s
-        with open(os.path.join(dirname, HP_FILE), "w") as f:
-             yaml.dump(HP_hifi, f)
+
+        if shard is None and checkpoint_every is None:
+            # Parameters sampling (LHS, Sobol or Halton)
+            X_lhs = sample(n_s, n_p, sampling, seed)
+            mu_lhs = mu_min + (mu_max - mu_min)*X_lhs
+
+            # Going through the snapshots one by one without saving them
+            if tol is None:
+                moments = self.compute_moments(n_s, moments, X, t, mu_lhs,
+                                               parallel)
+            else:
+                moments = self.compute_until(n_s, moments, X, t, mu_lhs,
+                                             parallel, tol, tol_norm,
+                                             n_s_batch, HP_hifi)
+            save_hifi(dirname, moments.get_mean(), moments.get_std(),
+                      HP_hifi)
+            return
+
+        if tol is not None:
+            raise ValueError("The tolerance can't be used with shards or " +
+                             "checkpoints.")
+
+        # Every shard and rerun has to share the same design
+        if seed is None:
+            raise ValueError("A seed is needed to shard or resume generate().")
+        if shard is None:
+            shard = (0, 1)
+        i, k = shard
+        HP_shard = dict(HP_hifi, sampling=sampling, seed=seed, shard=[i, k])
+        path = os.path.join(dirname, SHARD_FILE.format(i, k))
+        moments = load_shard(path, HP_shard, moments)
+
+        # Parameters sampling of this shard only
+        X_lhs = sample(n_s, n_p, sampling, seed, shard)
+        mu_lhs = mu_min + (mu_max - mu_min)*X_lhs
+        n_s_shard = mu_lhs.shape[0]
+        print(f"Shard {i}/{k}: {moments.n} of {n_s_shard} samples done")
+
+        # Checkpointing the partial moments every block of samples
+        n_b = max(1, checkpoint_every or n_s_shard)
+        for s in range(moments.n, n_s_shard, n_b):
+            e = min(n_s_shard, s + n_b)
+            moments = self.compute_moments(e - s, moments, X, t, mu_lhs[s:e],
+                                           parallel)
+            save_shard(path, HP_shard, moments)
+
+        if k == 1:
+            save_hifi(dirname, moments.get_mean(), moments.get_std(),
+                      HP_hifi)
+
+    def compute_moments(self, n_s, moments, X, t, mu_lhs, parallel=True,
+                        pbar=None):
+        """Add the snapshots of mu_lhs to the moments, possibly in parallel.
+
+        The progress goes to pbar if given, else to a bar of its own.
+        """
+        if parallel:
+            return self.computeParallel(n_s, moments, X, t, mu_lhs, pbar)
+        return self.compute(n_s, moments, X, t, mu_lhs, pbar)
+
+    def compute_until(self, n_s, moments, X, t, mu_lhs, parallel,
+                      tol, tol_norm, n_s_batch, HP_hifi):
+        """Add batches of snapshots to the moments until tol is reached.
+
+        The standard error of the std comes from the spread of the batches'
+        std (batch means method), so it's one more accumulator of a field.
+        A shorter last batch is only added to the moments, as its std is
+        more spread than the others'.
+        """
+        moments_std = Moments(moments.shape)
+        se_mean, se_std = np.inf, np.inf
+        pbar = tqdm(total=n_s)
+        for s in range(0, n_s, n_s_batch):
+            e = min(n_s, s + n_s_batch)
+            moments_b = Moments(moments.shape, dtype=moments.mean.dtype)
+            moments_b = self.compute_moments(e - s, moments_b, X, t,
+                                             mu_lhs[s:e], parallel, pbar)
+            moments.merge(moments_b)
+            if e - s == n_s_batch:
+                moments_std.update(moments_b.get_std())
+
+            se_mean, se_std = get_std_errors(moments, moments_std, tol_norm)
+            pbar.write(f"{moments.n} samples: relative standard errors " +
+                       f"{se_mean:.2e} (mean), {se_std:.2e} (std)")
+            if moments_std.n >= TOL_MIN_BATCHES and max(se_mean, se_std) < tol:
+                break
+        pbar.close()
+
+        # Reporting the achieved confidence
+        HP_hifi["n_s"] = moments.n
+        HP_hifi["n_s_max"] = n_s
+        HP_hifi["tol"] = tol
+        HP_hifi["tol_norm"] = tol_norm
+        HP_hifi["se_mean"] = float(se_mean)
+        HP_hifi["se_std"] = float(se_std)
+        HP_hifi["converged"] = bool(max(se_mean, se_std) < tol)
+        return moments
+
+
+def poll_progress(counts, pbar, stop, interval=PROGRESS_INTERVAL):
+    """Advance a progress bar by the per-chunk counts, until stop is set."""
+    n_start = pbar.n
+    while not stop.wait(interval):
+        pbar.update(n_start + int(counts.sum()) - pbar.n)
+    pbar.update(n_start + int(counts.sum()) - pbar.n)
+
+
+def get_std_errors(moments, moments_std, norm="l2"):
+    """Return the relative standard errors of the mean and std fields.
+
+    moments_std holds the std of each (equal-sized) batch of samples, and
+    the error of the std is infinite until there are two of them.
+    """
+    if norm not in ("l2", "max"):
+        raise ValueError(f"Unknown norm {norm}, expected l2 or max.")
+    order = np.inf if norm == "max" else None
+    def field_norm(U):
+        return np.linalg.norm(U.reshape(-1), order)
+
+    std = moments.get_std()
+    se_mean = field_norm(std) / np.sqrt(moments.n)
+    se_std = np.inf
+    if moments_std.n >= 2:
+        se_std = field_norm(moments_std.get_std()) / np.sqrt(moments_std.n)
+
+    # Relative to the fields, unless they vanish
+    se_mean /= field_norm(moments.get_mean()) or 1.
+    se_std /= field_norm(std) or 1.
+    return se_mean, se_std
+
+
+def save_hifi(dirname, U_mean, U_std, HP_hifi):
+    """Save the HiFi mean and std, and their hyperparams."""
+    np.save(os.path.join(dirname, U_MEAN_FILE), U_mean)
+    np.save(os.path.join(dirname, U_STD_FILE), U_std)
+    with open(os.path.join(dirname, HP_FILE), "w") as f:
+        yaml.dump(HP_hifi, f)
+
+
+def save_shard(path, HP_shard, moments):
+    """Save the partial moments of a shard and its hyperparams, atomically."""
+    with open(path + ".yaml", "w") as f:
+        yaml.dump(HP_shard, f)
+    with open(path + ".tmp", "wb") as f:
+        moments.save(f)
+    os.replace(path + ".tmp", path + ".npz")
+
+
+def load_shard(path, HP_shard, moments):
+    """Return the saved partial moments of a shard, or the given ones."""
+    if not os.path.exists(path + ".npz"):
+        return moments
+    with open(path + ".yaml") as f:
+        HP_saved = yaml.safe_load(f)
+    if HP_saved != HP_shard:
+        raise ValueError(f"{path} was generated with other settings, " +
+                         "remove it to start over.")
+    return Moments.load(path + ".npz")
+
+
+def merge_shards(paths=None, dirname="data"):
+    """Merge the partial moments of any shards into the HiFi test files.
+
+    The shards have to be distinct slices of a single sharded run, and
+    missing samples (shards absent or not done) are reported.
+    """
+    if paths is None:
+        paths = sorted(glob.glob(os.path.join(dirname, "shard_*.npz")))
+    if len(paths) == 0:
+        raise FileNotFoundError(f"Can't find any shard in {dirname}.")
+
+    moments = None
+    HP_hifi = None
+    run = None
+    indices = set()
+    for path in paths:
+        path = os.path.splitext(path)[0]
+        with open(path + ".yaml") as f:
+            HP_shard = yaml.safe_load(f)
+
+        # The shards have to come from the same run, and split it the same way
+        i, k = HP_shard.pop("shard")
+        run_shard = (k, HP_shard.pop("seed"), HP_shard.pop("sampling"))
+        if HP_hifi is not None and \
+                (HP_shard != HP_hifi or run_shard != run):
+            raise ValueError(f"{path} was generated with other settings " +
+                             "or another number of shards.")
+        if i in indices:
+            raise ValueError(f"{path} is a duplicate of shard {i}/{k}.")
+        HP_hifi, run = HP_shard, run_shard
+        indices.add(i)
+
+        moments_shard = Moments.load(path + ".npz")
+        moments = moments_shard if moments is None \
+            else moments.merge(moments_shard)
+
+    # The actual number of samples behind the statistics
+    print(f"Merged {len(paths)} shards, {moments.n} of {HP_hifi['n_s']} " +
+          "samples")
+    if moments.n > HP_hifi["n_s"]:
+        raise ValueError(f"The shards hold {moments.n} samples, more than " +
+                         f"the {HP_hifi['n_s']} of the run.")
+    if moments.n < HP_hifi["n_s"]:
+        missing = sorted(set(range(run[0])) - indices)
+        print(f"Warning: {HP_hifi['n_s'] - moments.n} samples are missing, " +
+              f"shards {missing} absent and others possibly not done")
+    HP_hifi["n_s"] = moments.n
+    save_hifi(dirname, moments.get_mean(), moments.get_std(), HP_hifi)
+    return moments
+
+
+if __name__ == "__main__":
+    # python -m podnn.testgenerator [data/shard_0_of_4.npz ...]
+    merge_shards(sys.argv[1:] or None)
@@ -0,0 +1,50 @@
+import time
+import numpy as np
+
+from podnn.podnnmodel import PodnnModel
+from podnn.mesh import create_linear_mesh
+from podnn.multifidelity import mfmc_mean_std
+
+
+def u(X, t, mu):
+    return np.sin(mu[0] * X)
+
+
+def get_slow_model(save_dir):
+    """Return a model whose surrogate is both costly and uncorrelated."""
+    model = PodnnModel(str(save_dir), 1, create_linear_mesh(0, 1, 32), 0)
+    model.V = np.zeros((model.n_h, 1))
+
+    def predict_v(X_v):
+        time.sleep(1e-3 * X_v.shape[0])
+        return np.zeros((X_v.shape[0], 1))
+    model.predict_v = predict_v
+    return model
+
+
+def get_reference(model, n_s=100000):
+    x = model.x_mesh[:, 1]
+    mu = np.random.RandomState(0).uniform(1., 3., n_s)
+    U = np.sin(mu[:, None] * x[None, :])
+    return U.mean(axis=0), U.std(axis=0, ddof=1)
+
+
+def test_unfavourable_cost_falls_back_to_mc(tmp_path):
+    model = get_slow_model(tmp_path)
+    U_mean, U_std, HP = mfmc_mean_std(model, u, [1.], [3.], 200,
+                                      n_pilot=20, seed=0)
+    assert HP["method"] == "mc"
+    assert HP["n_s"] == 200
+    assert HP["var_ratio"] == 1.
+
+    ref_mean, ref_std = get_reference(model)
+    assert np.linalg.norm(U_mean[0] - ref_mean) < \
+        1e-2 * np.linalg.norm(ref_mean)
+    assert np.linalg.norm(U_std[0] - ref_std) < 5e-2 * np.linalg.norm(ref_std)
+
+
+def test_pilot_over_budget_reuses_pilot(tmp_path):
+    model = get_slow_model(tmp_path)
+    _, _, HP = mfmc_mean_std(model, u, [1.], [3.], 10, n_pilot=20, seed=0)
+    assert HP["method"] == "mc"
+    assert HP["n_s"] == 20
@@ -0,0 +1,34 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+from podnn.solverpool import SolverPool
+
+# Writes u = [i, i, i, i] with np.save, which appends .npy to other names
+SAVE_COMMAND = [sys.executable, "-c",
+                "import sys, numpy as np; " +
+                "np.save(sys.argv[1], np.full(4, float(sys.argv[2])))",
+                "{path}", "{i}"]
+
+
+def test_run_commands_np_save(tmp_path):
+    mu_lhs = np.random.rand(5, 2)
+    pool = SolverPool(str(tmp_path), n_workers=2)
+    pool.run_commands(SAVE_COMMAND, mu_lhs)
+
+    _, U = pool.load(4)
+    assert np.array_equal(U, np.tile(np.arange(5.), (4, 1)))
+    # No temporary file left behind
+    assert not [f for f in os.listdir(tmp_path) if ".tmp" in f]
+
+
+def test_run_commands_failure(tmp_path):
+    mu_lhs = np.random.rand(3, 2)
+    pool = SolverPool(str(tmp_path), n_workers=2)
+    with pytest.raises(RuntimeError):
+        pool.run_commands([sys.executable, "-c", "import sys; sys.exit(1)"],
+                          mu_lhs)
+    # Resuming only runs the missing snapshots
+    pool.run_commands(SAVE_COMMAND, mu_lhs)
+    assert pool.get_pending(mu_lhs) == []